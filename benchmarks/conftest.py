@@ -0,0 +1,41 @@
+"""
+Shared fixtures of the micro-benchmarks: tiny random-weight models on CPU.
+"""
+
+import pytest
+import torch
+
+from fish_speech.models.text2semantic.llama import DualARTransformer
+from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+from fish_speech.tokenizer import FishTokenizer
+from tools.create_tiny_checkpoint import build_decoder, build_llama, build_tokenizer
+
+
+@pytest.fixture(scope="session", autouse=True)
+def deterministic():
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+
+
+@pytest.fixture(scope="session")
+def tokenizer(tmp_path_factory) -> FishTokenizer:
+    return build_tokenizer(tmp_path_factory.mktemp("tokenizer") / "tokenizer.tiktoken")
+
+
+@pytest.fixture(scope="session")
+def llama_model(tokenizer) -> DualARTransformer:
+    model = build_llama(tokenizer, max_seq_len=512)
+
+    with torch.device("cpu"):
+        model.setup_caches(
+            max_batch_size=1,
+            max_seq_len=model.config.max_seq_len,
+            dtype=torch.float32,
+        )
+
+    return model
+
+
+@pytest.fixture(scope="session")
+def firefly_model() -> FireflyArchitecture:
+    return build_decoder("firefly_gan_vq_tiny")
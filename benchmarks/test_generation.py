@@ -0,0 +1,127 @@
+import pytest
+import torch
+
+from fish_speech.models.text2semantic.inference import (
+    decode_one_token_ar,
+    logits_to_probs,
+)
+from fish_speech.models.text2semantic.llama import (
+    Attention,
+    KVCache,
+    precompute_freqs_cis,
+)
+
+SAMPLING_KWARGS = dict(
+    temperature=torch.tensor(0.7),
+    top_p=torch.tensor(0.7),
+    repetition_penalty=torch.tensor(1.2),
+)
+
+
+@pytest.mark.benchmark(group="sampling")
+@pytest.mark.parametrize("vocab_size", [1024, 32768])
+def test_logits_to_probs(benchmark, vocab_size):
+    logits = torch.randn(vocab_size)
+    previous_tokens = torch.randint(0, vocab_size, (16,))
+
+    # logits_to_probs applies the repetition penalty in place
+    probs = benchmark(
+        lambda: logits_to_probs(
+            logits.clone(), previous_tokens=previous_tokens, **SAMPLING_KWARGS
+        )
+    )
+
+    assert torch.allclose(probs.sum(), torch.tensor(1.0))
+
+
+@pytest.mark.benchmark(group="decode")
+@torch.inference_mode()
+def test_decode_one_token_ar(benchmark, llama_model):
+    num_codebooks = llama_model.config.num_codebooks
+    x = torch.zeros((1, num_codebooks + 1, 1), dtype=torch.int)
+    x[0, 0] = llama_model.tokenizer.semantic_begin_id
+    input_pos = torch.tensor([64], dtype=torch.long)
+    previous_tokens = torch.zeros((num_codebooks + 1, 16), dtype=torch.int)
+
+    codes = benchmark(
+        decode_one_token_ar,
+        model=llama_model,
+        x=x,
+        input_pos=input_pos,
+        semantic_ids=[],
+        previous_tokens=previous_tokens,
+        **SAMPLING_KWARGS,
+    )
+
+    assert codes.shape == (num_codebooks + 1, 1)
+
+
+@pytest.mark.benchmark(group="embed")
+@pytest.mark.parametrize("seq_len", [1, 256])
+@torch.inference_mode()
+def test_embed(benchmark, llama_model, seq_len):
+    num_codebooks = llama_model.config.num_codebooks
+    inp = torch.randint(
+        0, llama_model.config.codebook_size, (1, num_codebooks + 1, seq_len)
+    )
+    # Half of the positions are semantic tokens, the others plain text
+    inp[0, 0, ::2] = llama_model.tokenizer.semantic_begin_id
+
+    x = benchmark(llama_model.embed, inp)
+
+    assert x.shape == (1, seq_len, llama_model.config.dim)
+
+
+@pytest.fixture(scope="module")
+def attention(llama_model):
+    # A standalone layer, so that the KV cache of the model is left untouched
+    config = llama_model.config
+    attention = Attention(config)
+    attention.eval()
+
+    freqs_cis = precompute_freqs_cis(
+        config.max_seq_len, config.dim // config.n_head, config.rope_base
+    )
+    causal_mask = torch.tril(
+        torch.ones(config.max_seq_len, config.max_seq_len, dtype=torch.bool)
+    )
+
+    return config, attention, freqs_cis, causal_mask
+
+
+@pytest.mark.benchmark(group="attention")
+@pytest.mark.parametrize("seq_len", [64, 256])
+@torch.inference_mode()
+def test_attention_no_cache(benchmark, attention, seq_len):
+    config, attention, freqs_cis, causal_mask = attention
+    attention.kv_cache = None
+
+    x = torch.randn(1, seq_len, config.dim)
+    mask = causal_mask[None, None, :seq_len, :seq_len]
+
+    y = benchmark(attention, x, freqs_cis[:seq_len], mask)
+
+    assert y.shape == x.shape
+
+
+@pytest.mark.benchmark(group="attention")
+@pytest.mark.parametrize("position", [64, 256])
+@torch.inference_mode()
+def test_attention_kv_cache(benchmark, attention, position):
+    config, attention, freqs_cis, causal_mask = attention
+    attention.kv_cache = KVCache(
+        1,
+        config.max_seq_len,
+        config.n_local_heads,
+        config.dim // config.n_head,
+        dtype=torch.float32,
+    )
+
+    # One new token attending to the whole cache
+    x = torch.randn(1, 1, config.dim)
+    input_pos = torch.tensor([position], dtype=torch.long)
+    mask = causal_mask[None, None, input_pos]
+
+    y = benchmark(attention, x, freqs_cis[input_pos], mask, input_pos)
+
+    assert y.shape == x.shape
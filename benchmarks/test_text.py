@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from fish_speech.conversation import Conversation, Message, TextPart, VQPart
+from fish_speech.text import split_text
+
+TEXT = (
+    "Fish Speech is a text to speech model. It supports English, Chinese and Japanese! "
+    "The price is 3.14 dollars, or about 22.5 yuan, isn't it cheap? "
+    "Long sentences without any punctuation are split on spaces then on characters "
+) * 8
+
+
+@pytest.mark.benchmark(group="text")
+@pytest.mark.parametrize("length", [100, 200])
+def test_split_text(benchmark, length):
+    segments = benchmark(split_text, TEXT, length)
+
+    assert len(segments) > 1
+
+
+@pytest.mark.benchmark(group="text")
+def test_tokenizer_encode(benchmark, tokenizer):
+    tokens = benchmark(tokenizer.encode, TEXT)
+
+    assert len(tokens) > 0
+
+
+@pytest.mark.benchmark(group="text")
+def test_encode_for_inference(benchmark, tokenizer):
+    num_codebooks = 8
+    # int32, as returned by the VQ encoder
+    codes = torch.randint(0, 1024, (num_codebooks, 200), dtype=torch.int)
+    # A reference (text and codes) followed by the text to synthesize
+    messages = [
+        Message(role="system", parts=[TextPart(text="Speak out the provided text.")]),
+        Message(role="user", parts=[TextPart(text=TEXT[:200])]),
+        Message(
+            role="assistant",
+            parts=[VQPart(codes=codes)],
+            modality="voice",
+        ),
+        Message(role="user", parts=[TextPart(text=TEXT[200:400])]),
+        Message(role="assistant", parts=[], modality="voice", add_im_end=False),
+    ]
+    conversation = Conversation(messages)
+
+    values = benchmark(conversation.encode_for_inference, tokenizer, num_codebooks)
+
+    assert values.shape[0] == num_codebooks + 1
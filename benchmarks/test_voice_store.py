@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from fish_speech.inference_engine.reference_loader import stored_tokens
+from fish_speech.inference_engine.voice_store import VoiceStore
+from fish_speech.models.text2semantic.inference import encode_tokens
+
+
+@pytest.mark.benchmark(group="voice_store")
+@pytest.mark.parametrize("tier", ["memory", "disk"])
+def test_stored_voice_prompt(benchmark, tokenizer, tmp_path, tier):
+    num_codebooks = 8
+    folder = tmp_path / "references" / "voice"
+    folder.mkdir(parents=True)
+    audio_path = folder / "000.wav"
+    audio_path.write_bytes(b"RIFF" + bytes(1024))
+    audio_path.with_suffix(".lab").write_text("Hello world.", encoding="utf-8")
+
+    # int32, as returned by the VQ encoder
+    codes = torch.randint(0, 1024, (num_codebooks, 200), dtype=torch.int)
+    store = VoiceStore(tmp_path / "store")
+    store.save("voice", folder, [audio_path], [codes.numpy()], ["Hello world."])
+
+    def load_prompt():
+        if tier == "disk":
+            store.invalidate("voice")
+        ((tokens, _),) = store.lookup("voice", folder, [audio_path])
+        prompt_tokens = stored_tokens(tokens, "cpu")
+
+        # The prompt of the LLAMA worker, which rejects int64 codes
+        values = encode_tokens(
+            tokenizer,
+            "The text to synthesize.",
+            device="cpu",
+            prompt_tokens=prompt_tokens,
+            num_codebooks=num_codebooks,
+        )
+        return prompt_tokens, values
+
+    prompt_tokens, values = benchmark(load_prompt)
+
+    assert torch.equal(prompt_tokens, codes)
+    assert values.shape[0] == num_codebooks + 1
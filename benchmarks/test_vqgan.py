@@ -0,0 +1,18 @@
+import pytest
+import torch
+
+
+@pytest.mark.benchmark(group="vqgan")
+@pytest.mark.parametrize("num_tokens", [21, 105])
+@torch.inference_mode()
+def test_firefly_decode(benchmark, firefly_model, num_tokens):
+    # About 1 and 5 seconds of audio, at 21 tokens per second
+    n_groups = firefly_model.quantizer.residual_fsq.groups
+    indices = torch.randint(0, 1000, (1, n_groups, num_tokens))
+    feature_lengths = torch.tensor([num_tokens])
+
+    audios, audio_lengths = benchmark(
+        firefly_model.decode, indices=indices, feature_lengths=feature_lengths
+    )
+
+    assert audios.shape[-1] == audio_lengths[0]
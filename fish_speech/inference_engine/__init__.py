@@ -1,13 +1,26 @@
-import gc
 import queue
+import threading
+import time
+from collections import deque
 from typing import Generator
 
 import numpy as np
 import torch
 from loguru import logger
 
+from fish_speech.inference_engine.code_cache import SemanticCodeCache
+from fish_speech.inference_engine.inflight import InflightRequests
+from fish_speech.inference_engine.memory_manager import MemoryManager
+from fish_speech.inference_engine.reference_cache import ReferenceCache
 from fish_speech.inference_engine.reference_loader import ReferenceLoader
-from fish_speech.inference_engine.utils import InferenceResult, wav_chunk_header
+from fish_speech.inference_engine.utils import (
+    InferenceResult,
+    PCMAccumulator,
+    PCMStagingBuffer,
+    to_pcm16,
+    wav_chunk_header,
+)
+from fish_speech.inference_engine.voice_store import VoiceStore
 from fish_speech.inference_engine.vq_manager import VQManager
 from fish_speech.models.text2semantic.inference import (
     GenerateRequest,
@@ -16,7 +29,9 @@ from fish_speech.models.text2semantic.inference import (
 )
 from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
 from fish_speech.utils import autocast_exclude_mps, set_seed
+from fish_speech.utils.metrics import REAL_TIME_FACTOR, VOCODER_TIME
 from fish_speech.utils.schema import ServeTTSRequest
+from fish_speech.utils.tracing import span
 
 
 class TTSInferenceEngine(ReferenceLoader, VQManager):
@@ -27,42 +42,101 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
         decoder_model: FireflyArchitecture,
         precision: torch.dtype,
         compile: bool,
+        code_cache: SemanticCodeCache | None = None,
+        stream_tail_segments: int = 0,
+        memory_manager: MemoryManager | None = None,
+        voice_store: VoiceStore | None = None,
+        reference_cache: ReferenceCache | None = None,
+        reference_max_tokens: int | None = None,
+        reference_order: str = "given",
+        segment_batch_size: int = 4,
     ) -> None:
 
         super().__init__()
 
+        if voice_store is not None:
+            self.voice_store = voice_store
+        if reference_cache is not None:
+            self.ref_by_hash = reference_cache
+
         self.llama_queue = llama_queue
         self.decoder_model = decoder_model
+        # The server also runs the decoder in its VQGAN batchers, on other threads
+        self.decoder_lock = threading.RLock()
         self.precision = precision
         self.compile = compile
+        self.code_cache = code_cache
+        # Number of past segments kept when streaming, for the final result
+        self.stream_tail_segments = stream_tail_segments
+        self.memory_manager = memory_manager or MemoryManager(decoder_model.device)
+        # Token budget of the reference prompts, see generate_long
+        self.reference_max_tokens = reference_max_tokens
+        self.reference_order = reference_order
+        # Batch size of the parallel segments mode
+        self.segment_batch_size = segment_batch_size
+        self.inflight = InflightRequests()
 
-    @torch.inference_mode()
     def inference(self, req: ServeTTSRequest) -> Generator[InferenceResult, None, None]:
         """
         Main inference function:
         - Loads the reference audio and text.
-        - Calls the LLAMA model for inference.
-        - Decodes the VQ tokens to audio.
+        - Calls the LLAMA model for inference (or reuses the cached codes).
+        - Decodes the VQ tokens to int16 PCM audio.
+
+        The audio of a "segment" result is a view on a buffer reused by the request,
+        it is only valid until the next result is requested.
+        When streaming, past segments are not kept: the "final" result only holds
+        the last `stream_tail_segments` segments (no audio if 0).
+
+        Identical deterministic (seeded) requests in flight at the same time share
+        one inference, see InflightRequests.
         """
 
-        ref_id: str | None = req.reference_id
-        prompt_tokens, prompt_texts = [], []
-        # Load the reference audio and text based on id or hash
-        if ref_id is not None:
-            prompt_tokens, prompt_texts = self.load_by_id(ref_id, req.use_memory_cache)
+        # Without a seed, identical requests must give different audios:
+        # neither coalesced nor cached
+        if req.seed is None:
+            return self._inference(req, None)
 
-        elif req.references:
-            prompt_tokens, prompt_texts = self.load_by_hash(
-                req.references, req.use_memory_cache
-            )
+        codes_key = self.make_codes_key(req)
+        return self.inflight.run(
+            (codes_key, req.streaming), lambda: self._inference(req, codes_key)
+        )
 
-        # Set the random seed if provided
-        if req.seed is not None:
-            set_seed(req.seed)
-            logger.warning(f"set seed: {req.seed}")
+    def make_codes_key(self, req: ServeTTSRequest) -> str:
+        """
+        Key of the codes generated for a request, see SemanticCodeCache.make_key.
+        A stored voice is identified by its files, so an updated voice gets new codes.
+        """
+        voice = None
+        if req.reference_id is not None:
+            voice = self.reference_signature(req.reference_id)
 
-        # Get the symbolic tokens from the LLAMA model
-        response_queue = self.send_Llama_request(req, prompt_tokens, prompt_texts)
+        return SemanticCodeCache.make_key(
+            req, voice, self.reference_max_tokens, self.reference_order
+        )
+
+    @torch.inference_mode()
+    def _inference(
+        self, req: ServeTTSRequest, codes_key: str | None
+    ) -> Generator[InferenceResult, None, None]:
+
+        start_time = time.perf_counter()
+
+        # Look up the semantic codes cache first, it skips the LLAMA model entirely
+        cache_key, cached_codes = None, None
+        if (
+            codes_key is not None
+            and self.code_cache is not None
+            and self.code_cache.enabled
+        ):
+            cache_key = codes_key
+            cached_codes = self.code_cache.get(cache_key)
+
+        if cached_codes is not None:
+            logger.info(f"Use cached semantic codes: {cache_key}")
+            code_generator = self.iter_cached_codes(cached_codes)
+        else:
+            code_generator = self.iter_generated_codes(req)
 
         # Get the sample rate from the decoder model
         sample_rate = self.decoder_model.spec_transform.sample_rate
@@ -78,66 +152,149 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
                 error=None,
             )
 
-        segments = []
+        # When streaming, memory stays proportional to one segment (plus the tail)
+        if req.streaming:
+            segments = deque(maxlen=self.stream_tail_segments)
+        else:
+            segments = PCMAccumulator()
+
+        num_segments, num_audio_samples, generated_codes = 0, 0, []
+        # One per request: concurrent requests interleave on the event loop
+        pcm_buffer = PCMStagingBuffer()
+        store_codes = cache_key is not None and cached_codes is None
 
-        while True:
-            # Get the response from the LLAMA model
-            wrapped_result: WrappedGenerateResponse = response_queue.get()
-            if wrapped_result.status == "error":
-                yield InferenceResult(
-                    code="error",
-                    audio=None,
-                    error=(
-                        wrapped_result.response
-                        if isinstance(wrapped_result.response, Exception)
-                        else Exception("Unknown error")
-                    ),
-                )
+        for codes in code_generator:
+            if isinstance(codes, Exception):
+                yield InferenceResult(code="error", audio=None, error=codes)
+                # Never cache the codes of a failed request
+                store_codes = False
                 break
 
-            # Check the response type
-            if not isinstance(wrapped_result.response, GenerateResponse):
-                raise TypeError(
-                    "Expected GenerateResponse, got {type(wrapped_result.response).__name__}"
-                )
+            segment = self.get_audio_segment(codes, pcm_buffer)
 
-            result: GenerateResponse = wrapped_result.response
-            if result.action != "next":
-                segment = self.get_audio_segment(result)
-
-                if req.streaming:  # Used only by the API server
-                    yield InferenceResult(
-                        code="segment",
-                        audio=(sample_rate, segment),
-                        error=None,
-                    )
+            if req.streaming:  # Used only by the API server
+                yield InferenceResult(
+                    code="segment",
+                    audio=(sample_rate, segment),
+                    error=None,
+                )
+            if not req.streaming:
                 segments.append(segment)
-            else:
-                break
+            elif segments.maxlen:
+                # Copy, the segment is a view on the staging buffer
+                segments.append(segment.copy())
+
+            num_segments += 1
+            num_audio_samples += len(segment)
+            if store_codes:
+                generated_codes.append(codes)
+
+        # Persist the codes so that the next identical request skips the LLAMA model
+        if store_codes and generated_codes:
+            self.code_cache.put(cache_key, generated_codes)
+
+        if num_audio_samples > 0:
+            REAL_TIME_FACTOR.observe(
+                (time.perf_counter() - start_time) / (num_audio_samples / sample_rate)
+            )
 
-        # Clean up the memory
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            gc.collect()
+        # Only give the memory back under pressure, the allocator pool is reused
+        self.memory_manager.maybe_trim()
 
         # Edge case: no audio generated
-        if len(segments) == 0:
+        if num_segments == 0:
             yield InferenceResult(
                 code="error",
                 audio=None,
                 error=RuntimeError("No audio generated, please check the input text."),
             )
+        elif req.streaming:
+            # The segments were already sent, only return the kept tail if any
+            yield InferenceResult(
+                code="final",
+                audio=(sample_rate, np.concatenate(segments)) if segments else None,
+                error=None,
+            )
         else:
-            # Streaming or not, return the final audio
-            audio = np.concatenate(segments, axis=0)
             yield InferenceResult(
                 code="final",
-                audio=(sample_rate, audio),
+                audio=(sample_rate, segments.getvalue()),
                 error=None,
             )
 
         return None
 
+    def iter_generated_codes(
+        self, req: ServeTTSRequest
+    ) -> Generator[torch.Tensor | Exception, None, None]:
+        """
+        Yield the codes of each segment generated by the LLAMA model.
+        An exception is yielded (not raised) if the model fails.
+        """
+
+        ref_id: str | None = req.reference_id
+        prompt_tokens, prompt_texts = [], []
+        # Load the reference audio and text based on id or hash
+        if ref_id is not None:
+            try:
+                prompt_tokens, prompt_texts = self.load_by_id(
+                    ref_id, req.use_memory_cache
+                )
+            except ValueError as e:
+                # Invalid or unknown id
+                yield e
+                return
+
+        elif req.references:
+            prompt_tokens, prompt_texts = self.load_by_hash(
+                req.references, req.use_memory_cache
+            )
+
+        # Set the random seed if provided
+        if req.seed is not None:
+            set_seed(req.seed)
+            logger.warning(f"set seed: {req.seed}")
+
+        # Get the symbolic tokens from the LLAMA model
+        with span("llama.send_request"):
+            response_queue = self.send_Llama_request(req, prompt_tokens, prompt_texts)
+
+        while True:
+            # Get the response from the LLAMA model
+            with span("llama.wait_segment"):
+                wrapped_result: WrappedGenerateResponse = response_queue.get()
+            if wrapped_result.status == "error":
+                yield (
+                    wrapped_result.response
+                    if isinstance(wrapped_result.response, Exception)
+                    else Exception("Unknown error")
+                )
+                break
+
+            # Check the response type
+            if not isinstance(wrapped_result.response, GenerateResponse):
+                raise TypeError(
+                    "Expected GenerateResponse, got {type(wrapped_result.response).__name__}"
+                )
+
+            result: GenerateResponse = wrapped_result.response
+            if result.action == "next":
+                break
+
+            yield result.codes
+
+    def iter_cached_codes(
+        self, cached_codes: list[np.ndarray]
+    ) -> Generator[torch.Tensor, None, None]:
+        """
+        Yield the cached int16 codes of each segment as tensors on the decoder device.
+        """
+
+        for codes in cached_codes:
+            yield torch.from_numpy(np.asarray(codes, dtype=np.int32)).to(
+                self.decoder_model.device
+            )
+
     def send_Llama_request(
         self, req: ServeTTSRequest, prompt_tokens: list, prompt_texts: list
     ) -> queue.Queue:
@@ -159,6 +316,10 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             max_length=4096,
             prompt_tokens=prompt_tokens,
             prompt_text=prompt_texts,
+            max_prompt_tokens=self.reference_max_tokens,
+            prompt_order=self.reference_order,
+            parallel_segments=req.parallel_segments,
+            segment_batch_size=self.segment_batch_size,
         )
 
         # Create a queue to get the response
@@ -174,17 +335,27 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
 
         return response_queue
 
-    def get_audio_segment(self, result: GenerateResponse) -> np.ndarray:
+    def get_audio_segment(
+        self, codes: torch.Tensor, pcm_buffer: PCMStagingBuffer | None = None
+    ) -> np.ndarray:
         """
-        Decode the VQ tokens to audio.
+        Decode the VQ tokens to int16 PCM audio.
+        The conversion runs on the decoder device, then lands in the staging buffer
+        (a new one if None).
         """
 
+        t0 = time.perf_counter()
+
         # Don't use autocast on MPS devices
         with autocast_exclude_mps(
             device_type=self.decoder_model.device.type, dtype=self.precision
         ):
             # Decode the symbolic tokens to audio
-            segment = self.decode_vq_tokens(codes=result.codes)
+            segment = self.decode_vq_tokens(codes=codes)
+
+        # Convert the audio to PCM before leaving the device (half the bytes to copy)
+        pcm_buffer = pcm_buffer or PCMStagingBuffer()
+        pcm = pcm_buffer.copy_from(to_pcm16(segment))
+        VOCODER_TIME.observe(time.perf_counter() - t0)
 
-        # Convert the audio to numpy
-        return segment.float().cpu().numpy()
+        return pcm
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from hashlib import sha256
+from pathlib import Path
+
+import numpy as np
+import torch
+from cachetools import LRUCache
+from loguru import logger
+
+from fish_speech.utils.schema import ServeTTSRequest
+
+
+def model_fingerprint(paths: list[str | Path], **config) -> str:
+    """
+    Identity of the models generating the codes: the files of their checkpoints
+    (resolved path, size and mtime) and the settings in `config`.
+    """
+    files = []
+    for path in map(Path, paths):
+        path = path.resolve()
+        for file in sorted(path.rglob("*")) if path.is_dir() else [path]:
+            if file.is_file():
+                stat = file.stat()
+                files.append((str(file), stat.st_size, stat.st_mtime_ns))
+
+    payload = json.dumps({"files": files, "config": config}, sort_keys=True)
+    return sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class SemanticCodeCache:
+
+    def __init__(
+        self,
+        cache_dir: str | Path | None = None,
+        max_memory_bytes: int = 0,
+        mmap: bool = True,
+        fingerprint: str | None = None,
+    ) -> None:
+        """
+        Caches the semantic codes generated by the LLAMA model, per segment.
+        Codes are stored as int16 arrays, either in memory (LRU, bounded in bytes)
+        or on disk (one .npy file per segment, optionally memory-mapped on load).
+        The disk tier outlives the models: it is kept in a subfolder named by
+        their `fingerprint` (see model_fingerprint), if given.
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None and fingerprint is not None:
+            self.cache_dir = self.cache_dir / fingerprint
+        self.mmap = mmap
+        self.lock = threading.Lock()
+
+        self.memory: LRUCache | None = None
+        if max_memory_bytes > 0:
+            self.memory = LRUCache(
+                maxsize=max_memory_bytes,
+                getsizeof=lambda codes: max(sum(c.nbytes for c in codes), 1),
+            )
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory is not None or self.cache_dir is not None
+
+    @staticmethod
+    def make_key(
+        req: ServeTTSRequest,
+        voice: str | None = None,
+        max_prompt_tokens: int | None = None,
+        prompt_order: str = "given",
+    ) -> str:
+        """
+        Build the cache key from everything that influences the generated codes.
+        `voice` identifies the content of the stored voice of `req.reference_id`,
+        `max_prompt_tokens` and `prompt_order` pick the reference clips of the prompt.
+        The output format and streaming flag only affect the vocoder side.
+        Only seeded requests are cached, the others must stay random.
+        """
+        payload = dict(
+            text=req.text,
+            reference_id=req.reference_id,
+            voice=voice,
+            max_prompt_tokens=max_prompt_tokens,
+            prompt_order=prompt_order,
+            references=[
+                (sha256(ref.audio).hexdigest(), ref.text) for ref in req.references
+            ],
+            seed=req.seed,
+            normalize=req.normalize,
+            parallel_segments=req.parallel_segments,
+            chunk_length=req.chunk_length,
+            max_new_tokens=req.max_new_tokens,
+            top_p=req.top_p,
+            repetition_penalty=req.repetition_penalty,
+            temperature=req.temperature,
+        )
+
+        return sha256(
+            json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+
+    def _key_dir(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key: str) -> list[np.ndarray] | None:
+        """
+        Return the cached int16 codes of each segment, or None on a miss.
+        """
+        if self.memory is not None:
+            with self.lock:
+                codes = self.memory.get(key)
+            if codes is not None:
+                return codes
+
+        if self.cache_dir is None:
+            return None
+
+        key_dir = self._key_dir(key)
+        if not key_dir.is_dir():
+            return None
+
+        try:
+            codes = [
+                np.load(path, mmap_mode="r" if self.mmap else None)
+                for path in sorted(key_dir.glob("segment_*.npy"))
+            ]
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load cached codes {key}: {e}")
+            return None
+
+        if len(codes) == 0:
+            return None
+
+        if self.memory is not None:
+            with self.lock:
+                self.memory[key] = codes
+
+        return codes
+
+    def put(self, key: str, codes: list[torch.Tensor]) -> None:
+        """
+        Store the codes of each segment of a finished request.
+        """
+        codes = [c.cpu().numpy().astype(np.int16) for c in codes]
+
+        if self.memory is not None:
+            with self.lock:
+                try:
+                    self.memory[key] = codes
+                except ValueError:
+                    # Larger than the whole memory budget
+                    pass
+
+        if self.cache_dir is None:
+            return
+
+        key_dir = self._key_dir(key)
+        if key_dir.is_dir():
+            return
+
+        # Write into a temporary folder first so readers never see partial entries
+        key_dir.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=key_dir.parent, prefix=".tmp-"))
+        try:
+            for idx, c in enumerate(codes):
+                np.save(tmp_dir / f"segment_{idx:04d}.npy", c)
+            os.replace(tmp_dir, key_dir)
+        except OSError as e:
+            logger.warning(f"Failed to write cached codes {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,189 @@
+import threading
+from typing import Callable, Generator, Hashable
+
+from fish_speech.inference_engine.utils import InferenceResult
+
+
+class SharedInference:
+
+    def __init__(self, source: Generator[InferenceResult, None, None]) -> None:
+        """
+        Results of one inference, shared by identical requests.
+        The inference is pulled on demand, by the subscriber which needs the next
+        result first. With a single subscriber, the results are passed through as is.
+        With several, the segments are copied and kept until the slowest one got them.
+        Requests can only subscribe until the first segment: a later one would need
+        the past segments, it runs its own inference instead.
+        """
+        self.source = source
+        # `lock` guards the state, `pull_lock` the source, held while it runs
+        self.lock = threading.Lock()
+        self.pull_lock = threading.Lock()
+
+        # Kept results, the first one is result number `base`
+        self.results: list[InferenceResult] = []
+        self.base = 0
+        self.produced = 0
+        # Subscriber -> number of its next result
+        self.positions: dict[int, int] = {}
+        self.next_subscriber = 0
+
+        self.joinable = True
+        self.error: Exception | None = None
+        self.done = False
+
+    def subscribe(self) -> int | None:
+        """
+        Return the id of a new subscriber, None if it is too late to join.
+        """
+        with self.lock:
+            if not self.joinable:
+                return None
+
+            subscriber = self.next_subscriber
+            self.next_subscriber += 1
+            self.positions[subscriber] = 0
+            return subscriber
+
+    def unsubscribe(self, subscriber: int) -> bool:
+        """
+        Return True if it was the last subscriber.
+        """
+        with self.lock:
+            self.positions.pop(subscriber, None)
+            self._trim()
+            return not self.positions
+
+    def _trim(self) -> None:
+        # Everything is kept for the subscribers to come
+        if self.joinable:
+            return
+
+        start = min(self.positions.values(), default=self.produced)
+        del self.results[: start - self.base]
+        self.base = start
+
+    def get(self, subscriber: int) -> InferenceResult | None:
+        """
+        Return the next result of the subscriber, or None once the inference is over.
+        """
+        while True:
+            with self.lock:
+                index = self.positions[subscriber]
+                if index < self.produced:
+                    self.positions[subscriber] = index + 1
+                    result = self.results[index - self.base]
+                    self._trim()
+                    return result
+                if self.error is not None:
+                    raise self.error
+                if self.done:
+                    return None
+
+            with self.pull_lock:
+                with self.lock:
+                    # Another subscriber advanced it meanwhile
+                    if self.produced > index or self.done:
+                        continue
+
+                try:
+                    result = next(self.source)
+                except StopIteration:
+                    with self.lock:
+                        self.done = True
+                    return None
+                except Exception as e:
+                    with self.lock:
+                        self.error = e
+                        self.done = True
+                    raise
+
+                with self.lock:
+                    return self._publish(subscriber, result)
+
+    def _publish(self, subscriber: int, result: InferenceResult) -> InferenceResult:
+        if result.code == "segment":
+            self.joinable = False
+        self.produced += 1
+        self.positions[subscriber] = self.produced
+        self._trim()
+
+        if len(self.positions) == 1 and not self.joinable:
+            # Nobody else needs it, the kept results were trimmed as well
+            self.base = self.produced
+            return result
+
+        if result.code == "segment":
+            # Copy, the segment is a view on the staging buffer of the inference
+            sample_rate, audio = result.audio
+            result = InferenceResult(
+                code="segment", audio=(sample_rate, audio.copy()), error=None
+            )
+
+        self.results.append(result)
+        return result
+
+    def close(self) -> None:
+        with self.pull_lock, self.lock:
+            self.source.close()
+            self.done = True
+
+
+class InflightRequests:
+    # Monotonic stats, the others go up and down
+    COUNTERS = ("started", "coalesced")
+
+    def __init__(self) -> None:
+        """
+        Coalesces identical in-flight requests: the first one runs the inference,
+        the later ones subscribe to its results instead of running it again,
+        as long as no segment was produced, see SharedInference.
+        The inference is closed once its last subscriber is gone.
+        """
+        self.lock = threading.Lock()
+        self.entries: dict[Hashable, SharedInference] = {}
+
+        self.started = 0
+        self.coalesced = 0
+
+    def run(
+        self,
+        key: Hashable,
+        inference: Callable[[], Generator[InferenceResult, None, None]],
+    ) -> Generator[InferenceResult, None, None]:
+        with self.lock:
+            shared = self.entries.get(key)
+            subscriber = shared.subscribe() if shared is not None else None
+            if subscriber is None:
+                shared = SharedInference(inference())
+                subscriber = shared.subscribe()
+                self.entries[key] = shared
+                self.started += 1
+            else:
+                self.coalesced += 1
+
+        try:
+            while (result := shared.get(subscriber)) is not None:
+                yield result
+        finally:
+            with self.lock:
+                last = shared.unsubscribe(subscriber)
+                # Later identical requests start a new inference
+                if self.entries.get(key) is shared and (
+                    last or shared.done or not shared.joinable
+                ):
+                    del self.entries[key]
+
+            if last and not shared.done:
+                shared.close()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(
+                inflight=len(self.entries),
+                started=self.started,
+                coalesced=self.coalesced,
+            )
@@ -0,0 +1,129 @@
+import gc
+import threading
+import time
+
+import torch
+from loguru import logger
+
+from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+
+# Rough peak of the decoder activations per output sample (float32, last HiFiGAN stages)
+ARENA_BYTES_PER_SAMPLE = 64
+
+# Counters exposed from torch.cuda.memory_stats()
+ALLOCATOR_STATS = {
+    "allocated_bytes": "allocated_bytes.all.current",
+    "allocated_bytes_peak": "allocated_bytes.all.peak",
+    "reserved_bytes": "reserved_bytes.all.current",
+    "reserved_bytes_peak": "reserved_bytes.all.peak",
+    "inactive_split_bytes": "inactive_split_bytes.all.current",
+    "num_alloc_retries": "num_alloc_retries",
+    "num_ooms": "num_ooms",
+}
+
+
+def estimate_arena_bytes(
+    decoder_model: FireflyArchitecture, max_batch_size: int, max_seq_len: int
+) -> int:
+    """
+    Estimate the memory needed to decode `max_batch_size` sequences of `max_seq_len` tokens.
+    """
+    samples_per_token = (
+        decoder_model.downsample_factor * decoder_model.spec_transform.hop_length
+    )
+
+    return max_batch_size * max_seq_len * samples_per_token * ARENA_BYTES_PER_SAMPLE
+
+
+class MemoryManager:
+
+    def __init__(
+        self,
+        device: torch.device | str,
+        high_watermark: float = 0.9,
+        trim_interval: float = 0,
+        arena_bytes: int = 0,
+    ) -> None:
+        """
+        Decides when to give the cached CUDA memory back to the driver.
+        The caching allocator pool is kept between requests, and only trimmed when
+        the reserved memory goes above `high_watermark` (fraction of the device memory)
+        or every `trim_interval` seconds (0 to disable).
+        An arena of `arena_bytes` can be reserved at startup, and after each trim.
+        """
+        self.device = torch.device(device)
+        self.high_watermark = high_watermark
+        self.trim_interval = trim_interval
+        self.arena_bytes = arena_bytes
+
+        self.enabled = self.device.type == "cuda" and torch.cuda.is_available()
+        self.lock = threading.Lock()
+        self.last_trim = time.monotonic()
+        self.num_trims = 0
+
+        if self.enabled and self.arena_bytes > 0:
+            self.reserve_arena()
+
+    def reserve_arena(self) -> None:
+        """
+        Allocate then free one block, so that the caching allocator keeps it reserved.
+        Later requests are served from this block instead of calling cudaMalloc.
+        """
+        try:
+            block = torch.empty(self.arena_bytes, dtype=torch.uint8, device=self.device)
+            del block
+        except torch.cuda.OutOfMemoryError:
+            logger.warning(f"Failed to reserve a {self.arena_bytes / 1e9:.2f} GB arena")
+            return
+
+        logger.info(f"Reserved a {self.arena_bytes / 1e9:.2f} GB memory arena")
+
+    def total_memory(self) -> int:
+        return torch.cuda.get_device_properties(self.device).total_memory
+
+    def should_trim(self) -> bool:
+        if self.trim_interval > 0 and (
+            time.monotonic() - self.last_trim >= self.trim_interval
+        ):
+            return True
+
+        reserved = torch.cuda.memory_reserved(self.device)
+        return reserved > self.high_watermark * self.total_memory()
+
+    def trim(self) -> None:
+        with self.lock:
+            gc.collect()
+            torch.cuda.empty_cache()
+            self.last_trim = time.monotonic()
+            self.num_trims += 1
+
+            if self.arena_bytes > 0:
+                self.reserve_arena()
+
+    def maybe_trim(self) -> bool:
+        """
+        Called after each request, cheap when there is nothing to do.
+        """
+        if not self.enabled or not self.should_trim():
+            return False
+
+        self.trim()
+        return True
+
+    def stats(self) -> dict[str, int | float]:
+        if not self.enabled:
+            return {"enabled": False}
+
+        memory_stats = torch.cuda.memory_stats(self.device)
+        stats = {
+            name: memory_stats.get(key, 0) for name, key in ALLOCATOR_STATS.items()
+        }
+        stats.update(
+            enabled=True,
+            total_bytes=self.total_memory(),
+            high_watermark=self.high_watermark,
+            arena_bytes=self.arena_bytes,
+            num_trims=self.num_trims,
+        )
+
+        return stats
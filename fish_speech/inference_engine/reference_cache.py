@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class ReferenceCache:
+    # Monotonic stats, the others go up and down
+    COUNTERS = ("hits", "misses", "evictions", "offloads")
+
+    def __init__(
+        self,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_device_bytes: int | None = None,
+        offload_device: str = "cpu",
+    ) -> None:
+        """
+        LRU cache of the encoded reference tokens, bounded in bytes.
+        Past `max_bytes`, the least recently used entries are evicted.
+        Past `max_device_bytes` (None for no limit), the least recently used entries
+        are moved to `offload_device`, and back to their device on the next hit.
+        """
+        self.max_bytes = max_bytes
+        self.max_device_bytes = max_device_bytes
+        self.offload_device = torch.device(offload_device)
+        self.lock = threading.Lock()
+
+        # key -> (tokens, device of the tokens when they were put)
+        self.entries: OrderedDict[str, tuple[torch.Tensor, torch.device]] = (
+            OrderedDict()
+        )
+        self.bytes = 0
+        self.device_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.offloads = 0
+
+    def get(self, key: str) -> torch.Tensor | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            tokens, device = entry
+
+            if tokens.device != device:
+                # Offloaded, back to its device
+                tokens = tokens.to(device, non_blocking=True)
+                self.entries[key] = (tokens, device)
+                self.device_bytes += tokens.nbytes
+                self._offload()
+
+            return tokens
+
+    def put(self, key: str, tokens: torch.Tensor) -> None:
+        size = tokens.nbytes
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (tokens, tokens.device)
+            self.bytes += size
+            if tokens.device != self.offload_device:
+                self.device_bytes += size
+
+            # Least recently used first
+            while self.bytes > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+                self.evictions += 1
+
+            self._offload()
+
+    def _pop(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        tokens, _ = entry
+        self.bytes -= tokens.nbytes
+        if tokens.device != self.offload_device:
+            self.device_bytes -= tokens.nbytes
+
+    def _offload(self) -> None:
+        if self.max_device_bytes is None:
+            return
+
+        for key, (tokens, device) in list(self.entries.items()):
+            if self.device_bytes <= self.max_device_bytes:
+                break
+            if tokens.device == self.offload_device:
+                continue
+
+            self.entries[key] = (tokens.to(self.offload_device), device)
+            self.device_bytes -= tokens.nbytes
+            self.offloads += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.device_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(
+                entries=len(self.entries),
+                bytes=self.bytes,
+                device_bytes=self.device_bytes,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                offloads=self.offloads,
+            )
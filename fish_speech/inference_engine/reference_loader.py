@@ -1,20 +1,58 @@
 import io
+import os
+import shutil
+import tempfile
+from functools import lru_cache
 from hashlib import sha256
 from pathlib import Path
 from typing import Callable, Literal, Tuple
 
+import numpy as np
+import soundfile as sf
 import torch
 import torchaudio
 from loguru import logger
 
+from fish_speech.inference_engine.reference_cache import ReferenceCache
+from fish_speech.inference_engine.voice_store import VoiceStore, file_stat
 from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
 from fish_speech.utils.file import (
     AUDIO_EXTENSIONS,
-    audio_to_bytes,
     list_files,
     read_ref_text,
 )
 from fish_speech.utils.schema import ServeReferenceAudio
+from fish_speech.utils.tracing import span
+
+REFERENCES_DIR = Path("references")
+# Voices saved through the API: references/.versions/<id>/<version>, the current
+# version being named by the references/<id>/VERSION file
+VERSIONS_DIR = REFERENCES_DIR / ".versions"
+VERSION_FILE = "VERSION"
+
+
+def is_valid_reference_id(id: str) -> bool:
+    # Reference ids are folder names: no path separators, and no leading dot,
+    # which rules out ".." and the internal folders (.versions, temporary files)
+    return (
+        0 < len(id) <= 255
+        and not id.startswith(".")
+        and not any(c in id for c in "/\\\0")
+    )
+
+
+def stored_tokens(tokens: np.ndarray, device) -> torch.Tensor:
+    """
+    Tokens of the voice store (int16) as prompt tokens.
+    int32, as returned by the VQ encoder: encode_tokens rejects int64 codes.
+    """
+    return torch.from_numpy(np.asarray(tokens, dtype=np.int32)).to(device)
+
+
+@lru_cache(maxsize=16)
+def get_resampler(orig_freq: int, new_freq: int) -> torchaudio.transforms.Resample:
+    # Building the resampling kernel is not free, reuse it for each source rate
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
 
 
 class ReferenceLoader:
@@ -24,12 +62,13 @@ class ReferenceLoader:
         Component of the TTSInferenceEngine class.
         Loads and manages the cache for the reference audio and text.
         """
-        self.ref_by_id: dict = {}
-        self.ref_by_hash: dict = {}
+        self.voice_store = VoiceStore()
+        self.ref_by_hash = ReferenceCache()
 
         # Make Pylance happy (attribut/method not defined...)
         self.decoder_model: FireflyArchitecture
         self.encode_reference: Callable
+        self.encode_references: Callable
 
         # Define the torchaudio backend
         backends = torchaudio.list_audio_backends()
@@ -44,64 +83,210 @@ class ReferenceLoader:
         use_cache: Literal["on", "off"],
     ) -> Tuple:
 
+        with span("reference.load_by_id", reference_id=id):
+            return self._load_by_id(id, use_cache)
+
+    def _load_by_id(
+        self,
+        id: str,
+        use_cache: Literal["on", "off"],
+    ) -> Tuple:
+
         # Load the references audio and text by id
-        ref_folder = Path("references") / id
-        ref_folder.mkdir(parents=True, exist_ok=True)
-        ref_audios = list_files(
-            ref_folder, AUDIO_EXTENSIONS, recursive=True, sort=False
-        )
+        ref_folder = self.voice_folder(id)
+        if ref_folder is None:
+            raise ValueError(f"Unknown reference id: {id!r}")
+        ref_audios = list_files(ref_folder, AUDIO_EXTENSIONS, recursive=True, sort=True)
 
-        if use_cache == "off" or id not in self.ref_by_id:
-            # If the references are not already loaded, encode them
-            prompt_tokens = [
-                self.encode_reference(
-                    # decoder_model=self.decoder_model,
-                    reference_audio=audio_to_bytes(str(ref_audio)),
-                    enable_reference_audio=True,
-                )
-                for ref_audio in ref_audios
-            ]
-            prompt_texts = [
-                read_ref_text(str(ref_audio.with_suffix(".lab")))
-                for ref_audio in ref_audios
-            ]
-            self.ref_by_id[id] = (prompt_tokens, prompt_texts)
+        # The store is checked against the files, so it is always used
+        stored = self.voice_store.lookup(id, ref_folder, ref_audios)
 
-        else:
+        # New or modified references, encoded together
+        missing = [i for i, entry in enumerate(stored) if entry is None]
+        encoded = self.encode_references([str(ref_audios[i]) for i in missing])
+        encoded = dict(zip(missing, encoded))
+
+        prompt_tokens, prompt_texts = [], []
+        for i, (ref_audio, entry) in enumerate(zip(ref_audios, stored)):
+            if entry is None:
+                prompt_tokens.append(encoded[i])
+                prompt_texts.append(read_ref_text(str(ref_audio.with_suffix(".lab"))))
+                continue
+
+            tokens, text = entry
+            prompt_tokens.append(stored_tokens(tokens, self.decoder_model.device))
+            prompt_texts.append(text)
+
+        if any(entry is None for entry in stored):
+            self.voice_store.save(
+                id,
+                ref_folder,
+                ref_audios,
+                [tokens.cpu().numpy() for tokens in prompt_tokens],
+                prompt_texts,
+            )
+        elif stored:
             # Reuse already encoded references
             logger.info("Use same references")
-            prompt_tokens, prompt_texts = self.ref_by_id[id]
 
         return prompt_tokens, prompt_texts
 
+    def reference_folder(self, id: str) -> Path:
+        if not is_valid_reference_id(id):
+            raise ValueError(f"Invalid reference id: {id!r}")
+
+        return REFERENCES_DIR / id
+
+    def voice_folder(self, id: str) -> Path | None:
+        """
+        Folder holding the current files of a voice, None if it is unknown.
+        references/<id> itself, unless the voice was saved through the API.
+        """
+        ref_folder = self.reference_folder(id)
+        try:
+            version = (ref_folder / VERSION_FILE).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return ref_folder if ref_folder.is_dir() else None
+
+        return VERSIONS_DIR / id / version
+
+    def reference_signature(self, id: str) -> str | None:
+        """
+        Digest of the names and stats of the files of a voice, None if it is unknown.
+        It changes whenever the voice is updated.
+        """
+        try:
+            ref_folder = self.voice_folder(id)
+        except ValueError:
+            return None
+        if ref_folder is None:
+            return None
+
+        ref_audios = list_files(ref_folder, AUDIO_EXTENSIONS, recursive=True, sort=True)
+        signature = [
+            (p.relative_to(ref_folder).as_posix(), *file_stat(p, p.with_suffix(".lab")))
+            for p in ref_audios
+        ]
+
+        return sha256(repr(signature).encode("utf-8")).hexdigest()
+
+    def get_reference(self, id: str) -> dict | None:
+        ref_folder = self.voice_folder(id)
+        if ref_folder is None:
+            return None
+
+        ref_audios = list_files(ref_folder, AUDIO_EXTENSIONS, recursive=True, sort=True)
+        return dict(
+            id=id,
+            texts=[read_ref_text(str(p.with_suffix(".lab"))) for p in ref_audios],
+        )
+
+    def list_references(self) -> list[dict]:
+        if not REFERENCES_DIR.is_dir():
+            return []
+
+        return [
+            self.get_reference(folder.name)
+            for folder in sorted(REFERENCES_DIR.iterdir())
+            if folder.is_dir() and is_valid_reference_id(folder.name)
+        ]
+
+    def save_reference(self, id: str, references: list[ServeReferenceAudio]) -> dict:
+        """
+        Write the references of a voice as a new version, replacing the previous
+        ones, and encode them: later requests with this reference_id reuse them.
+        """
+        ref_folder = self.reference_folder(id)
+        sample_rate = self.decoder_model.spec_transform.sample_rate
+
+        # Decode everything first, an invalid audio leaves the voice untouched
+        try:
+            audios = [self.load_audio(ref.audio, sample_rate) for ref in references]
+        except RuntimeError as e:
+            raise ValueError(f"Invalid reference audio: {e}") from e
+
+        # The new version is written aside, then made current at once
+        versions = VERSIONS_DIR / id
+        versions.mkdir(parents=True, exist_ok=True)
+        version_folder = Path(tempfile.mkdtemp(dir=versions, prefix="v-"))
+        for i, (audio, ref) in enumerate(zip(audios, references)):
+            sf.write(version_folder / f"{i:03d}.wav", audio, sample_rate)
+            (version_folder / f"{i:03d}.lab").write_text(ref.text, encoding="utf-8")
+
+        previous = self.voice_folder(id)
+        ref_folder.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=ref_folder, prefix=f".{VERSION_FILE}-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(version_folder.name)
+        # Atomic, a concurrent request sees either the previous voice or this one
+        os.replace(tmp_path, ref_folder / VERSION_FILE)
+
+        # Files of a voice which was not saved through the API
+        for path in ref_folder.iterdir():
+            if path.name == VERSION_FILE:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+
+        # Keep the previous version, requests may still be reading it
+        for folder in versions.iterdir():
+            if folder not in (version_folder, previous):
+                shutil.rmtree(folder, ignore_errors=True)
+
+        self.load_by_id(id, use_cache="on")
+
+        return self.get_reference(id)
+
+    def delete_reference(self, id: str) -> bool:
+        ref_folder = self.reference_folder(id)
+        if not ref_folder.is_dir():
+            return False
+
+        shutil.rmtree(ref_folder)
+        shutil.rmtree(VERSIONS_DIR / id, ignore_errors=True)
+        self.voice_store.delete(id)
+
+        return True
+
     def load_by_hash(
         self,
         references: list[ServeReferenceAudio],
         use_cache: Literal["on", "off"],
     ) -> Tuple:
 
+        with span("reference.load_by_hash", references=len(references)):
+            return self._load_by_hash(references, use_cache)
+
+    def _load_by_hash(
+        self,
+        references: list[ServeReferenceAudio],
+        use_cache: Literal["on", "off"],
+    ) -> Tuple:
+
         # Load the references audio and text by hash
         audio_hashes = [sha256(ref.audio).hexdigest() for ref in references]
 
         cache_used = False
         prompt_tokens, prompt_texts = [], []
-        for i, ref in enumerate(references):
-            if use_cache == "off" or audio_hashes[i] not in self.ref_by_hash:
-                # If the references are not already loaded, encode them
-                prompt_tokens.append(
-                    self.encode_reference(
-                        reference_audio=ref.audio,
-                        enable_reference_audio=True,
-                    )
-                )
-                prompt_texts.append(ref.text)
-                self.ref_by_hash[audio_hashes[i]] = (prompt_tokens, prompt_texts)
+        for audio_hash, ref in zip(audio_hashes, references):
+            tokens = self.ref_by_hash.get(audio_hash) if use_cache == "on" else None
 
+            if tokens is None:
+                # If the reference is not already loaded, encode it
+                tokens = self.encode_reference(
+                    reference_audio=ref.audio,
+                    enable_reference_audio=True,
+                )
+                self.ref_by_hash.put(audio_hash, tokens)
             else:
-                # Reuse already encoded references
-                prompt_tokens, prompt_texts = self.ref_by_hash[audio_hashes[i]]
                 cache_used = True
 
+            # The text always comes from the request, only the audio is cached
+            prompt_tokens.append(tokens)
+            prompt_texts.append(ref.text)
+
         if cache_used:
             logger.info("Use same references")
 
@@ -109,22 +294,40 @@ class ReferenceLoader:
 
     def load_audio(self, reference_audio, sr):
         """
-        Load the audio data from a file or bytes.
+        Load the audio data from a file path or bytes.
+        WAV files are read with libsndfile, the other formats go through torchaudio.
         """
-        if len(reference_audio) > 255 or not Path(reference_audio).exists():
-            audio_data = reference_audio
-            reference_audio = io.BytesIO(audio_data)
+        if isinstance(reference_audio, (bytes, bytearray, memoryview)):
+            header = bytes(reference_audio[:12])
+            is_wav = header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+            reference_audio = io.BytesIO(reference_audio)
+        else:
+            reference_audio = str(reference_audio)
+            is_wav = reference_audio.lower().endswith(".wav")
 
-        waveform, original_sr = torchaudio.load(reference_audio, backend=self.backend)
+        waveform = None
+        if is_wav:
+            try:
+                data, original_sr = sf.read(
+                    reference_audio, dtype="float32", always_2d=True
+                )
+                waveform = torch.from_numpy(data.T)
+            except RuntimeError as e:
+                # Unsupported WAV subtype, let the backend try
+                logger.debug(f"Failed to read the WAV reference: {e}")
+                if isinstance(reference_audio, io.BytesIO):
+                    reference_audio.seek(0)
+
+        if waveform is None:
+            waveform, original_sr = torchaudio.load(
+                reference_audio, backend=self.backend
+            )
 
         if waveform.shape[0] > 1:
             waveform = torch.mean(waveform, dim=0, keepdim=True)
 
         if original_sr != sr:
-            resampler = torchaudio.transforms.Resample(
-                orig_freq=original_sr, new_freq=sr
-            )
-            waveform = resampler(waveform)
+            waveform = get_resampler(original_sr, sr)(waveform)
 
         audio = waveform.squeeze().numpy()
         return audio
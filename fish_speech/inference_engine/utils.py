@@ -4,6 +4,10 @@ from dataclasses import dataclass
 from typing import Literal, Optional, Tuple
 
 import numpy as np
+import torch
+
+# Scale of the float audio in [-1, 1] to int16 PCM
+AMPLITUDE = 32768
 
 
 @dataclass
@@ -27,3 +31,68 @@ def wav_chunk_header(
     buffer.close()
 
     return wav_header_bytes
+
+
+def to_pcm16(audio: torch.Tensor) -> torch.Tensor:
+    """
+    Convert float audio to int16 PCM, on the device of the audio.
+    """
+    return (audio.float() * AMPLITUDE).clamp_(-AMPLITUDE, AMPLITUDE - 1).to(torch.int16)
+
+
+class PCMStagingBuffer:
+
+    def __init__(self) -> None:
+        """
+        Reusable host buffer receiving the int16 PCM of the decoder.
+        It is pinned when the decoder runs on CUDA, so the copy is a single DMA.
+        The returned arrays are views: they are only valid until the next copy.
+        """
+        self.buffer: torch.Tensor | None = None
+
+    def copy_from(self, pcm: torch.Tensor) -> np.ndarray:
+        pcm = pcm.reshape(-1)
+
+        # Tensors on the CPU are already on the host, no copy needed
+        if pcm.device.type == "cpu":
+            return pcm.numpy()
+
+        size = pcm.numel()
+        if self.buffer is None or self.buffer.numel() < size:
+            self.buffer = torch.empty(
+                size * 2, dtype=torch.int16, pin_memory=pcm.device.type == "cuda"
+            )
+
+        view = self.buffer[:size]
+        view.copy_(pcm, non_blocking=pcm.device.type == "cuda")
+        if pcm.device.type == "cuda":
+            torch.cuda.current_stream(pcm.device).synchronize()
+
+        return view.numpy()
+
+
+class PCMAccumulator:
+
+    def __init__(self, initial_size: int = 0) -> None:
+        """
+        Growable int16 buffer, appending each segment in place
+        so that the final audio doesn't need a concatenation.
+        """
+        self.buffer = np.empty(initial_size, dtype=np.int16)
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, pcm: np.ndarray) -> None:
+        end = self.length + len(pcm)
+        if end > len(self.buffer):
+            buffer = np.empty(max(end, len(self.buffer) * 2), dtype=np.int16)
+            buffer[: self.length] = self.buffer[: self.length]
+            self.buffer = buffer
+
+        self.buffer[self.length : end] = pcm
+        self.length = end
+
+    def getvalue(self) -> np.ndarray:
+        return self.buffer[: self.length]
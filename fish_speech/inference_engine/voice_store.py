@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from hashlib import sha256
+from pathlib import Path
+
+import numpy as np
+from cachetools import LRUCache
+from loguru import logger
+
+from fish_speech.utils.file import read_ref_text
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_digest(path: Path) -> str:
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def file_stat(audio_path: Path, text_path: Path) -> list[int]:
+    """
+    Cheap change detection: mtime and size of the audio, mtime of its text.
+    """
+    audio_stat = audio_path.stat()
+    text_mtime = text_path.stat().st_mtime_ns if text_path.exists() else 0
+
+    return [audio_stat.st_mtime_ns, audio_stat.st_size, text_mtime]
+
+
+class VoiceStore:
+
+    def __init__(
+        self,
+        root: str | Path | None = None,
+        max_memory_voices: int = 64,
+        mmap: bool = True,
+    ) -> None:
+        """
+        Persistent store of the encoded reference voices (references/<id>).
+        Each voice has a folder with a manifest (source files, mtime, size, hash, text)
+        and the prompt tokens of each audio as int16 .npy files, named by audio hash.
+        Entries are checked against the source files on each load: a changed mtime
+        falls back to the hash, so touched but identical files are not re-encoded.
+        The most recently used voices are also kept in memory (LRU).
+        Without `root`, only the memory tier is used.
+        """
+        self.root = Path(root) if root is not None else None
+        self.mmap = mmap
+        self.lock = threading.Lock()
+        self.memory: LRUCache = LRUCache(maxsize=max(max_memory_voices, 1))
+
+        if self.root is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+
+    def _voice_dir(self, voice_id: str) -> Path:
+        return self.root / voice_id
+
+    def _read_manifest(self, voice_id: str) -> dict:
+        path = self._voice_dir(voice_id) / MANIFEST_NAME
+        try:
+            manifest = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+
+        return manifest.get("entries", {})
+
+    def _write_manifest(self, voice_id: str, entries: dict) -> None:
+        voice_dir = self._voice_dir(voice_id)
+        data = json.dumps(
+            {"version": MANIFEST_VERSION, "entries": entries},
+            indent=2,
+            ensure_ascii=False,
+        )
+
+        # Replace atomically, other workers may be reading it
+        fd, tmp_path = tempfile.mkstemp(dir=voice_dir, prefix=".manifest-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, voice_dir / MANIFEST_NAME)
+        except OSError as e:
+            logger.warning(f"Failed to write the manifest of voice {voice_id}: {e}")
+            Path(tmp_path).unlink(missing_ok=True)
+
+    def _write_tokens(self, path: Path, tokens: np.ndarray) -> None:
+        if path.exists():
+            return
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tokens-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, tokens)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write tokens {path}: {e}")
+            Path(tmp_path).unlink(missing_ok=True)
+
+    def lookup(
+        self,
+        voice_id: str,
+        folder: Path,
+        audio_paths: list[Path],
+    ) -> list[tuple[np.ndarray, str] | None]:
+        """
+        Return the stored (int16 tokens, text) of each audio of the voice folder,
+        None for the audios which must be (re-)encoded.
+        """
+        names = [p.relative_to(folder).as_posix() for p in audio_paths]
+        stats = [file_stat(p, p.with_suffix(".lab")) for p in audio_paths]
+        signature = tuple((name, *s) for name, s in zip(names, stats))
+
+        with self.lock:
+            cached = self.memory.get(voice_id)
+        if cached is not None and cached[0] == signature:
+            return list(cached[1])
+
+        if self.root is None:
+            return [None] * len(audio_paths)
+
+        entries = self._read_manifest(voice_id)
+        results, touched = [], False
+
+        for name, path, stat in zip(names, audio_paths, stats):
+            entry = entries.get(name)
+            if entry is None:
+                results.append(None)
+                continue
+
+            if entry["stat"] != stat:
+                # Modified or only touched, the content decides
+                audio_changed = entry["stat"][:2] != stat[:2]
+                if audio_changed and file_digest(path) != entry["sha256"]:
+                    results.append(None)
+                    continue
+
+                # The text may have changed, not the audio
+                entry["text"] = read_ref_text(str(path.with_suffix(".lab")))
+                entry["stat"] = stat
+                touched = True
+
+            tokens_path = self._voice_dir(voice_id) / entry["tokens"]
+            try:
+                tokens = np.load(tokens_path, mmap_mode="r" if self.mmap else None)
+            except (OSError, ValueError):
+                results.append(None)
+                continue
+
+            results.append((tokens, entry["text"]))
+
+        if touched:
+            self._write_manifest(voice_id, entries)
+
+        if all(result is not None for result in results):
+            with self.lock:
+                self.memory[voice_id] = (signature, results)
+
+        return results
+
+    def save(
+        self,
+        voice_id: str,
+        folder: Path,
+        audio_paths: list[Path],
+        tokens: list[np.ndarray],
+        texts: list[str],
+    ) -> None:
+        """
+        Store the tokens and texts of all the audios of a voice folder.
+        """
+        names = [p.relative_to(folder).as_posix() for p in audio_paths]
+        stats = [file_stat(p, p.with_suffix(".lab")) for p in audio_paths]
+        tokens = [np.asarray(t, dtype=np.int16) for t in tokens]
+        signature = tuple((name, *s) for name, s in zip(names, stats))
+
+        with self.lock:
+            self.memory[voice_id] = (signature, list(zip(tokens, texts)))
+
+        if self.root is None:
+            return
+
+        voice_dir = self._voice_dir(voice_id)
+        voice_dir.mkdir(parents=True, exist_ok=True)
+
+        entries = {}
+        for name, path, stat, t, text in zip(names, audio_paths, stats, tokens, texts):
+            digest = file_digest(path)
+            self._write_tokens(voice_dir / f"{digest}.npy", t)
+            entries[name] = {
+                "sha256": digest,
+                "stat": stat,
+                "text": text,
+                "tokens": f"{digest}.npy",
+                "shape": list(t.shape),
+            }
+
+        self._write_manifest(voice_id, entries)
+
+        # Tokens of audios which are no longer part of the voice
+        used = {entry["tokens"] for entry in entries.values()}
+        for stale in voice_dir.glob("*.npy"):
+            if stale.name not in used:
+                stale.unlink(missing_ok=True)
+
+    def invalidate(self, voice_id: str) -> None:
+        with self.lock:
+            self.memory.pop(voice_id, None)
+
+    def delete(self, voice_id: str) -> None:
+        self.invalidate(voice_id)
+
+        if self.root is not None:
+            shutil.rmtree(self._voice_dir(voice_id), ignore_errors=True)
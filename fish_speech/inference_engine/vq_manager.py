@@ -1,9 +1,20 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
 import torch
 from loguru import logger
 
 from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+from fish_speech.utils.tracing import span
+
+REFERENCE_LOAD_WORKERS = int(os.getenv("REFERENCE_LOAD_WORKERS", 4))
+
+# Decodes and resamples the reference audios of a voice in parallel
+reference_load_pool = ThreadPoolExecutor(
+    max_workers=REFERENCE_LOAD_WORKERS, thread_name_prefix="reference_load"
+)
 
 
 class VQManager:
@@ -11,6 +22,7 @@ class VQManager:
     def __init__(self):
         # Make Pylance happy (attribut/method not defined...)
         self.decoder_model: FireflyArchitecture
+        self.decoder_lock: threading.RLock
         self.load_audio: Callable
 
     def decode_vq_tokens(self, codes):
@@ -20,19 +32,21 @@ class VQManager:
         logger.info(f"VQ features: {codes.shape}")
 
         if isinstance(self.decoder_model, FireflyArchitecture):
-            return self.decoder_model.decode(
-                indices=codes[None],
-                feature_lengths=feature_lengths,
-            )[0].squeeze()
+            with span("vq.decode", tokens=codes.shape[1]), self.decoder_lock:
+                return self.decoder_model.decode(
+                    indices=codes[None],
+                    feature_lengths=feature_lengths,
+                )[0].squeeze()
 
         raise ValueError(f"Unknown model type: {type(self.decoder_model)}")
 
     def encode_reference(self, reference_audio, enable_reference_audio):
         if enable_reference_audio and reference_audio is not None:
             # Load audios, and prepare basic info here
-            reference_audio_content = self.load_audio(
-                reference_audio, self.decoder_model.spec_transform.sample_rate
-            )
+            with span("reference.load_audio"):
+                reference_audio_content = self.load_audio(
+                    reference_audio, self.decoder_model.spec_transform.sample_rate
+                )
 
             audios = torch.from_numpy(reference_audio_content).to(
                 self.decoder_model.device
@@ -46,7 +60,12 @@ class VQManager:
 
             # VQ Encoder
             if isinstance(self.decoder_model, FireflyArchitecture):
-                prompt_tokens = self.decoder_model.encode(audios, audio_lengths)[0][0]
+                with (
+                    span("vq.encode_reference", samples=audios.shape[2]),
+                    self.decoder_lock,
+                ):
+                    indices, _ = self.decoder_model.encode(audios, audio_lengths)
+                prompt_tokens = indices[0]
                 logger.info(f"Encoded prompt: {prompt_tokens.shape}")
             else:
                 raise ValueError(f"Unknown model type: {type(self.decoder_model)}")
@@ -55,3 +74,49 @@ class VQManager:
             logger.info("No reference audio provided")
 
         return prompt_tokens
+
+    def encode_references(self, reference_audios: list) -> list[torch.Tensor]:
+        """
+        Encode several references (paths or bytes) at once: the audios are loaded
+        on a thread pool, then encoded in one padded batch.
+        """
+        if len(reference_audios) == 0:
+            return []
+
+        if not isinstance(self.decoder_model, FireflyArchitecture):
+            raise ValueError(f"Unknown model type: {type(self.decoder_model)}")
+
+        sample_rate = self.decoder_model.spec_transform.sample_rate
+        device = self.decoder_model.device
+
+        with span("reference.load_audio", references=len(reference_audios)):
+            contents = list(
+                reference_load_pool.map(
+                    lambda audio: self.load_audio(audio, sample_rate), reference_audios
+                )
+            )
+
+        lengths = [len(content) for content in contents]
+        audios = torch.zeros((len(contents), 1, max(lengths)), dtype=torch.float32)
+        for i, content in enumerate(contents):
+            audios[i, 0, : lengths[i]] = torch.from_numpy(content)
+
+        audios = audios.to(device)
+        audio_lengths = torch.tensor(lengths, device=device, dtype=torch.long)
+        logger.info(
+            f"Loaded {len(lengths)} audios with {sum(lengths) / sample_rate:.2f} seconds"
+        )
+
+        with (
+            span("vq.encode_reference", samples=sum(lengths), batch=len(lengths)),
+            self.decoder_lock,
+        ):
+            indices, feature_lengths = self.decoder_model.encode(audios, audio_lengths)
+
+        # Drop the padding of each reference
+        prompt_tokens = [
+            indices[i, :, : feature_lengths[i]] for i in range(len(reference_audios))
+        ]
+        logger.info(f"Encoded prompts: {[tokens.shape for tokens in prompt_tokens]}")
+
+        return prompt_tokens
@@ -2,8 +2,9 @@ import os
 import queue
 import threading
 import time
-from contextlib import nullcontext
-from dataclasses import dataclass
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from hashlib import sha256
 from pathlib import Path
 from typing import Literal, Optional, Tuple, Union
 
@@ -12,6 +13,7 @@ import numpy as np
 import torch
 import torch._dynamo.config
 import torch._inductor.config
+from cachetools import LRUCache
 from loguru import logger
 from tqdm import tqdm
 from transformers import AutoTokenizer
@@ -26,6 +28,18 @@ from fish_speech.conversation import (
 from fish_speech.models.text2semantic.llama import BaseModelArgs
 from fish_speech.text import clean_text, split_text
 from fish_speech.tokenizer import IM_END_TOKEN, FishTokenizer
+from fish_speech.utils.metrics import DECODE_TOKEN_TIME, PREFILL_TIME, QUEUE_WAIT
+from fish_speech.utils.profiler import RequestProfiler
+from fish_speech.utils.tracing import (
+    Span,
+    Trace,
+    current_span,
+    current_trace,
+    record_span,
+    span,
+    timings_enabled,
+    use_trace,
+)
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 torch._inductor.config.coordinate_descent_tuning = True
@@ -44,6 +58,10 @@ from fish_speech.models.text2semantic.llama import (
     NaiveTransformer,
 )
 
+# Encoded reference prompts (after the budget selection), per voice
+PROMPT_CACHE_SIZE = 32
+prompt_cache = LRUCache(maxsize=PROMPT_CACHE_SIZE)
+
 
 def multinomial_sample_one_no_sync(
     probs_sort,
@@ -312,6 +330,65 @@ def decode_one_token_ar(
     return codebooks
 
 
+def decode_one_token_ar_batch(
+    model: DualARTransformer,
+    x: torch.Tensor,
+    input_pos: torch.Tensor,
+    semantic_ids: list,
+    previous_tokens: torch.Tensor = None,
+    key_mask: torch.Tensor = None,
+    **sampling_kwargs,
+) -> torch.Tensor:
+    """
+    Batched decode_one_token_ar: x is (B, num_codebooks + 1, T), previous_tokens
+    (B, num_codebooks + 1, W), and the result (B, num_codebooks + 1, 1).
+    """
+    x = model.forward_generate(x, input_pos, key_mask=key_mask)
+
+    codebooks = [
+        sample_agent(
+            x.logits,
+            previous_tokens=(
+                previous_tokens[:, 0] if previous_tokens is not None else None
+            ),
+            **sampling_kwargs,
+        )[0]
+    ]
+
+    hidden_states = x.hidden_states
+
+    # Cleanup the cache
+    for layer in model.fast_layers:
+        layer.attention.kv_cache.k_cache.fill_(0)
+        layer.attention.kv_cache.v_cache.fill_(0)
+
+    input_pos = torch.tensor([0], device=hidden_states.device, dtype=torch.long)
+    model.forward_generate_fast(hidden_states, input_pos)
+    a = codebooks[0] - model.tokenizer.semantic_begin_id
+    a[a < 0] = 0
+    hidden_states = model.fast_embeddings(a)
+    codebooks.append(a)
+
+    for codebook_idx in range(1, model.config.num_codebooks):
+        input_pos = torch.tensor(
+            [codebook_idx], device=hidden_states.device, dtype=torch.long
+        )
+        logits = model.forward_generate_fast(hidden_states, input_pos)
+        a = sample_agent(
+            logits,
+            previous_tokens=(
+                previous_tokens[:, codebook_idx + 1]
+                if previous_tokens is not None
+                else None
+            ),
+            **sampling_kwargs,
+        )[0]
+        hidden_states = model.fast_embeddings(a)
+        codebooks.append(a)
+
+    return torch.stack(codebooks, dim=1)
+
+
 def decode_one_token_naive(
     model: NaiveTransformer,
     x: torch.Tensor,
@@ -448,6 +525,7 @@ def generate(
         else decode_one_token_ar
     )
 
+    t0 = time.perf_counter()
     next_token = prefill_decode(
         model,
         prompt.view(1, codebook_dim, -1),
@@ -457,6 +535,15 @@ def generate(
     )
     seq[:, T : T + 1] = next_token
 
+    # Without a sync, the time on CUDA is only the launch time: but the sync stalls
+    # the pipeline, so it is only measured when the timings are looked at
+    if not torch.cuda.is_available():
+        PREFILL_TIME.observe(time.perf_counter() - t0)
+    elif timings_enabled():
+        torch.cuda.synchronize()
+        PREFILL_TIME.observe(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
     input_pos = torch.tensor([T], device=device, dtype=torch.int)
     x = decode_n_tokens(
         model,
@@ -467,6 +554,8 @@ def generate(
         semantic_ids=semantic_ids,
         **sampling_kwargs,
     )
+    # The stop condition syncs on every token, no extra sync needed here
+    DECODE_TOKEN_TIME.observe((time.perf_counter() - t0) / max(x.size(1), 1))
     # x = torch.cat(generated_tokens, dim=1)
     seq = seq[:, : T + 1 + x.size(1)]
     seq[:, T + 1 :] = x
@@ -474,6 +563,126 @@ def generate(
     return seq
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def generate_batch(
+    *,
+    model: DualARTransformer,
+    prompts: list[torch.Tensor],
+    max_new_tokens: int,
+    **sampling_kwargs,
+) -> list[torch.Tensor]:
+    """
+    Continue several prompts at once, as one batch: the prompts are left padded
+    and each sequence stops on its own <|im_end|>.
+    Returns the prompt and generated tokens of each sequence, as generate does.
+    """
+
+    batch_size = len(prompts)
+    prompt_lengths = [prompt.size(1) for prompt in prompts]
+    T = max(prompt_lengths)
+    semantic_ids = [
+        model.tokenizer.get_token_id(f"<|semantic:{i}|>") for i in range(1024)
+    ]
+    im_end_id = model.tokenizer.get_token_id(IM_END_TOKEN)
+
+    if max_new_tokens:
+        if T + max_new_tokens > model.config.max_seq_len:
+            max_new_tokens = model.config.max_seq_len - T
+            logger.info(f"Truncating max_new_tokens to {max_new_tokens}")
+    else:
+        max_new_tokens = model.config.max_seq_len - T
+
+    device = prompts[0].device
+    codebook_dim = 1 + model.config.num_codebooks
+
+    # Pad with the first token of each prompt, masked out anyway
+    x = torch.stack(
+        [
+            torch.cat([prompt[:, :1].expand(-1, T - prompt.size(1)), prompt], dim=1)
+            for prompt in prompts
+        ]
+    )
+    key_mask = torch.ones(
+        (batch_size, model.max_seq_len), dtype=torch.bool, device=device
+    )
+    for b, length in enumerate(prompt_lengths):
+        key_mask[b, : T - length] = False
+
+    t0 = time.perf_counter()
+    first_token = decode_one_token_ar_batch(
+        model,
+        x,
+        torch.arange(0, T, device=device),
+        semantic_ids=semantic_ids,
+        key_mask=key_mask,
+        **sampling_kwargs,
+    )
+
+    # Without a sync, the time on CUDA is only the launch time: but the sync stalls
+    # the pipeline, so it is only measured when the timings are looked at
+    if not torch.cuda.is_available():
+        PREFILL_TIME.observe(time.perf_counter() - t0)
+    elif timings_enabled():
+        torch.cuda.synchronize()
+        PREFILL_TIME.observe(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    previous_tokens = torch.zeros(
+        (batch_size, codebook_dim, model.config.max_seq_len),
+        dtype=torch.int,
+        device=device,
+    )
+    # Each sequence keeps its own stopping state
+    finished = first_token[:, 0, -1] == im_end_id
+    num_tokens = torch.zeros(batch_size, dtype=torch.long, device=device)
+    cur_token = first_token
+    input_pos = torch.tensor([T], device=device, dtype=torch.int)
+
+    for i in tqdm(range(max_new_tokens - 1)):
+        if finished.all():
+            break
+
+        # We need to get windowed repeat penalty
+        win_size = 16
+        if i < win_size:
+            window = previous_tokens[:, :, :win_size]
+        else:
+            window = previous_tokens[:, :, i - win_size : i]
+
+        with sdpa_kernel(SDPBackend.MATH):
+            cur_token = decode_one_token_ar_batch(
+                model,
+                cur_token,
+                input_pos,
+                semantic_ids=semantic_ids,
+                previous_tokens=window,
+                key_mask=key_mask,
+                **sampling_kwargs,
+            )
+
+        input_pos += 1
+        previous_tokens[:, :, i : i + 1] = cur_token
+        num_tokens[~finished] = i + 1
+        finished |= cur_token[:, 0, -1] == im_end_id
+
+    DECODE_TOKEN_TIME.observe(
+        (time.perf_counter() - t0) / max(int(num_tokens.max()), 1)
+    )
+
+    return [
+        torch.cat(
+            [
+                prompts[b],
+                first_token[b].to(prompts[b].dtype),
+                previous_tokens[b, :, : num_tokens[b]].to(prompts[b].dtype),
+            ],
+            dim=1,
+        )
+        for b in range(batch_size)
+    ]
+
+
 def decode_n_tokens_agent(
     model: NaiveTransformer,
     cur_token: torch.Tensor,
@@ -672,6 +881,105 @@ def encode_tokens(
     return encoded.to(device)
 
 
+def encode_system_prompt(tokenizer, device="cuda", num_codebooks=4) -> torch.Tensor:
+    return (
+        Conversation(
+            messages=[
+                Message(
+                    role="system",
+                    parts=[TextPart(text="Speak out the provided text.")],
+                    cal_loss=False,
+                )
+            ]
+        )
+        .encode_for_inference(
+            tokenizer=tokenizer,
+            num_codebooks=num_codebooks,
+        )
+        .to(device)
+    )
+
+
+def encode_reference_prompts(
+    tokenizer,
+    prompt_text: list[str],
+    prompt_tokens: list[torch.Tensor],
+    max_tokens: Optional[int],
+    order: Literal["given", "shortest", "longest"] = "given",
+    device="cuda",
+    num_codebooks=4,
+) -> list[torch.Tensor]:
+    """
+    Encode the reference clips which fit in `max_tokens` prompt tokens,
+    all of them if `max_tokens` is None. Clips are considered in the given order, or shortest / longest first, and
+    keep their original order in the prompt. If none fits, the shortest one is
+    cut (codes and text alike) to about the budget.
+    The result is cached per voice, budget and order.
+    """
+    digest = sha256()
+    for t, c in zip(prompt_text, prompt_tokens):
+        digest.update(t.encode("utf-8"))
+        digest.update(c.cpu().numpy().tobytes())
+    key = (digest.hexdigest(), max_tokens, order, str(device))
+
+    cached = prompt_cache.get(key)
+    if cached is not None:
+        return cached
+
+    encoded = [
+        encode_tokens(
+            tokenizer,
+            string=t,
+            device=device,
+            prompt_tokens=c,
+            num_codebooks=num_codebooks,
+        )
+        for t, c in zip(prompt_text, prompt_tokens)
+    ]
+    lengths = [e.shape[1] for e in encoded]
+
+    candidates = list(range(len(encoded)))
+    if order != "given":
+        candidates.sort(key=lambda i: lengths[i], reverse=order == "longest")
+
+    chosen, total = [], 0
+    for i in candidates:
+        if max_tokens is None or total + lengths[i] <= max_tokens:
+            chosen.append(i)
+            total += lengths[i]
+
+    if chosen:
+        prompts = [encoded[i] for i in sorted(chosen)]
+    elif encoded:
+        i = min(candidates, key=lambda i: lengths[i])
+        ratio = max_tokens / lengths[i]
+        logger.warning(
+            f"Reference prompt of {lengths[i]} tokens over the budget of "
+            f"{max_tokens}, keeping its first {ratio:.0%}"
+        )
+        codes = prompt_tokens[i]
+        prompts = [
+            encode_tokens(
+                tokenizer,
+                string=prompt_text[i][: int(len(prompt_text[i]) * ratio)],
+                device=device,
+                prompt_tokens=codes[..., : max(int(codes.shape[-1] * ratio), 1)],
+                num_codebooks=num_codebooks,
+            )
+        ]
+    else:
+        prompts = []
+
+    if len(chosen) < len(encoded):
+        logger.info(
+            f"Using {len(chosen)}/{len(encoded)} reference clips "
+            f"({sum(p.shape[1] for p in prompts)} tokens, budget {max_tokens})"
+        )
+
+    prompt_cache[key] = prompts
+    return prompts
+
+
 def load_model(checkpoint_path, device, precision, compile=False, is_agent=False):
     model: Union[NaiveTransformer, DualARTransformer] = BaseTransformer.from_pretrained(
         checkpoint_path, load_weights=True, is_agent=is_agent
@@ -708,6 +1016,161 @@ class GenerateResponse:
     action: Literal["sample", "next"]
     codes: Optional[torch.Tensor] = None
     text: Optional[str] = None
+    sample_idx: int = 0
+
+
+def build_context(
+    global_encoded: list[torch.Tensor],
+    encoded_prompts: list[torch.Tensor],
+    max_length: int,
+    use_prompt: bool,
+) -> torch.Tensor:
+    """
+    Prompt of the next segment: the references, the first segments and as many
+    of the last ones as fit in the window.
+    """
+    lengths = reversed([seg.size(1) for seg in global_encoded])
+
+    # Pick last 2000 tokens
+    count = 0
+    for i, length in enumerate(lengths):
+        count += length
+        if count + length > max_length - 1024 - sum(
+            t.shape[1] for t in encoded_prompts
+        ):
+            break
+
+    if i != 0 and i % 2 == 0:
+        i -= 1
+
+    # Rotate the list, always make sure first segment is included to avoid drift
+    if i < len(global_encoded) - 2:
+        partial_encoded = global_encoded[:2] + global_encoded[-i:]
+    else:
+        partial_encoded = global_encoded
+
+    if use_prompt:
+        partial_encoded = encoded_prompts + partial_encoded
+
+    return torch.cat(partial_encoded, dim=1)
+
+
+def grow_batch_caches(model: DualARTransformer, device, batch_size: int) -> None:
+    if model.max_batch_size >= batch_size:
+        return
+
+    with torch.device(device):
+        model.setup_caches(
+            max_batch_size=batch_size,
+            max_seq_len=model.config.max_seq_len,
+            dtype=next(model.parameters()).dtype,
+        )
+
+
+@contextmanager
+def batch_caches(model, device, batch_size: int):
+    """
+    Grow the KV caches to `batch_size` for the block, then back to a batch of 1,
+    which is all the other requests need. Caches already that large are kept.
+    """
+    if batch_size <= 1 or model.max_batch_size >= batch_size:
+        yield
+        return
+
+    grow_batch_caches(model, device, batch_size)
+    try:
+        yield
+    finally:
+        # setup_caches only ever grows them
+        model.max_batch_size = -1
+        with torch.device(device):
+            model.setup_caches(
+                max_batch_size=1,
+                max_seq_len=model.config.max_seq_len,
+                dtype=next(model.parameters()).dtype,
+            )
+
+
+def generate_segments_parallel(
+    *,
+    model,
+    device,
+    decode_one_token: callable,
+    encoded: list[torch.Tensor],
+    encoded_prompts: list[torch.Tensor],
+    texts: list[str],
+    num_samples: int,
+    max_length: int,
+    use_prompt: bool,
+    segment_batch_size: int,
+    **sampling_kwargs,
+):
+    """
+    Generate the segments independently of each other: each one is only
+    conditioned on the references, so they run as batches of `segment_batch_size`.
+    The responses are yielded in the order of the segments, as generate_long does.
+    """
+    prompts = [
+        build_context(
+            [seg], encoded_prompts, max_length=max_length, use_prompt=use_prompt
+        )
+        for seg in encoded
+    ]
+
+    # Only the DualAR model has a batched decode
+    step = segment_batch_size if isinstance(model, DualARTransformer) else 1
+    with batch_caches(model, device, min(step, len(prompts))):
+        for sample_idx in range(num_samples):
+            for start in range(0, len(prompts), step):
+                batch = prompts[start : start + step]
+                logger.info(
+                    f"Generating sentences {start + 1}-{start + len(batch)}/{len(prompts)} of sample {sample_idx + 1}/{num_samples}"
+                )
+
+                t0 = time.perf_counter()
+                with span(
+                    "llama.generate",
+                    segment=start,
+                    prompt_length=max(prompt.size(1) for prompt in batch),
+                    batch_size=len(batch),
+                ):
+                    if len(batch) == 1:
+                        ys = [
+                            generate(
+                                model=model,
+                                prompt=batch[0],
+                                decode_one_token=decode_one_token,
+                                **sampling_kwargs,
+                            )
+                        ]
+                    else:
+                        ys = generate_batch(
+                            model=model, prompts=batch, **sampling_kwargs
+                        )
+
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+
+                tokens_generated = sum(
+                    y.size(1) - prompt.size(1) for y, prompt in zip(ys, batch)
+                )
+                t = time.perf_counter() - t0
+                logger.info(
+                    f"Generated {tokens_generated} tokens in {t:.02f} seconds, {tokens_generated / t:.02f} tokens/sec"
+                )
+
+                for seg_idx, (y, prompt) in enumerate(zip(ys, batch), start=start):
+                    # Without the <im_end> token
+                    codes = y[1:, prompt.size(1) + 1 :].clone()
+                    assert (codes >= 0).all(), f"Negative code found: {codes}"
+                    yield GenerateResponse(
+                        action="sample",
+                        codes=codes,
+                        text=texts[seg_idx],
+                        sample_idx=sample_idx,
+                    )
+
+            yield GenerateResponse(action="next", sample_idx=sample_idx)
 
 
 def generate_long(
@@ -727,6 +1190,10 @@ def generate_long(
     chunk_length: int = 150,
     prompt_text: Optional[str | list[str]] = None,
     prompt_tokens: Optional[torch.Tensor | list[torch.Tensor]] = None,
+    max_prompt_tokens: Optional[int] = None,
+    prompt_order: Literal["given", "shortest", "longest"] = "given",
+    parallel_segments: bool = False,
+    segment_batch_size: int = 4,
 ):
     assert 0 < top_p <= 1, "top_p must be in (0, 1]"
     assert 0 < repetition_penalty < 2, "repetition_penalty must be in (0, 2)"
@@ -748,33 +1215,21 @@ def generate_long(
     encoded = []
     texts = split_text(text, chunk_length) if iterative_prompt else [text]
     encoded_prompts = [
-        Conversation(
-            messages=[
-                Message(
-                    role="system",
-                    parts=[TextPart(text="Speak out the provided text.")],
-                    cal_loss=False,
-                )
-            ]
-        )
-        .encode_for_inference(
-            tokenizer=tokenizer,
-            num_codebooks=model.config.num_codebooks,
-        )
-        .to(device)
+        encode_system_prompt(tokenizer, device, model.config.num_codebooks)
     ]
 
     if use_prompt:
-        for idx, (t, c) in enumerate(zip(prompt_text, prompt_tokens)):
-            encoded_prompts.append(
-                encode_tokens(
-                    tokenizer,
-                    string=t,
-                    device=device,
-                    prompt_tokens=c,
-                    num_codebooks=model.config.num_codebooks,
-                )
+        encoded_prompts.extend(
+            encode_reference_prompts(
+                tokenizer,
+                prompt_text=prompt_text,
+                prompt_tokens=prompt_tokens,
+                max_tokens=max_prompt_tokens,
+                order=prompt_order,
+                device=device,
+                num_codebooks=model.config.num_codebooks,
             )
+        )
 
     for idx, text in enumerate(texts):
         encoded.append(
@@ -795,95 +1250,130 @@ def generate_long(
         repetition_penalty, device=device, dtype=torch.float
     )
 
-    for sample_idx in range(num_samples):
-        if torch.cuda.is_available():
-            torch.cuda.synchronize()
-
-        global_encoded = []
-        seg_idx = 0
-
-        while seg_idx < len(encoded):
-            logger.info(
-                f"Generating sentence {seg_idx + 1}/{len(encoded)} of sample {sample_idx + 1}/{num_samples}"
-            )
-
-            seg = encoded[seg_idx]
-            global_encoded.append(seg)
-
-            lengths = reversed([seg.size(1) for seg in global_encoded])
-
-            # Pick last 2000 tokens
-            count = 0
-            for i, length in enumerate(lengths):
-                count += length
-                if count + length > max_length - 1024 - sum(
-                    t.shape[1] for t in encoded_prompts
-                ):
-                    break
-
-            if i != 0 and i % 2 == 0:
-                i -= 1
-
-            # Rotate the list, always make sure first segment is included to avoid drift
-            if i < len(global_encoded) - 2:
-                partial_encoded = global_encoded[:2] + global_encoded[-i:]
-            else:
-                partial_encoded = global_encoded
-
-            if use_prompt:
-                partial_encoded = encoded_prompts + partial_encoded
-
-            cat_encoded = torch.cat(partial_encoded, dim=1)
-            prompt_length = cat_encoded.size(1)
-
-            t0 = time.perf_counter()
-            y = generate(
-                model=model,
-                prompt=cat_encoded,
-                max_new_tokens=max_new_tokens,
-                decode_one_token=decode_one_token,
-                temperature=temperature,
-                top_p=top_p,
-                repetition_penalty=repetition_penalty,
-            )
+    if parallel_segments:
+        yield from generate_segments_parallel(
+            model=model,
+            device=device,
+            decode_one_token=decode_one_token,
+            encoded=encoded,
+            encoded_prompts=encoded_prompts,
+            texts=texts,
+            num_samples=num_samples,
+            max_length=max_length,
+            use_prompt=use_prompt,
+            segment_batch_size=segment_batch_size,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
+        return
 
-            if sample_idx == 0 and seg_idx == 0 and compile:
-                logger.info(f"Compilation time: {time.perf_counter() - t0:.2f} seconds")
+    # With a DualAR model, the samples are generated together, as one batch
+    if num_samples > 1 and isinstance(model, DualARTransformer):
+        sample_groups = [list(range(num_samples))]
+    else:
+        sample_groups = [[sample_idx] for sample_idx in range(num_samples)]
 
+    with batch_caches(model, device, max(map(len, sample_groups), default=1)):
+        for group in sample_groups:
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
 
-            t = time.perf_counter() - t0
+            global_encoded = {sample_idx: [] for sample_idx in group}
 
-            tokens_generated = y.size(1) - prompt_length
-            tokens_sec = tokens_generated / t
-            logger.info(
-                f"Generated {tokens_generated} tokens in {t:.02f} seconds, {tokens_sec:.02f} tokens/sec"
-            )
-            logger.info(
-                f"Bandwidth achieved: {model_size * tokens_sec / 1e9:.02f} GB/s"
-            )
-
-            if torch.cuda.is_available():
+            for seg_idx, seg in enumerate(encoded):
                 logger.info(
-                    f"GPU Memory used: {torch.cuda.max_memory_reserved() / 1e9:.02f} GB"
+                    f"Generating sentence {seg_idx + 1}/{len(encoded)} of samples {[i + 1 for i in group]}/{num_samples}"
                 )
 
-            # Put the generated tokens
-            # since there is <im_end>, we remove last token
-            codes = y[1:, prompt_length + 1 :].clone()
-            assert (codes >= 0).all(), f"Negative code found"
+                prompts = []
+                for sample_idx in group:
+                    global_encoded[sample_idx].append(seg)
+                    prompts.append(
+                        build_context(
+                            global_encoded[sample_idx],
+                            encoded_prompts,
+                            max_length=max_length,
+                            use_prompt=use_prompt,
+                        )
+                    )
+                prompt_lengths = [prompt.size(1) for prompt in prompts]
+
+                t0 = time.perf_counter()
+                with span(
+                    "llama.generate",
+                    segment=seg_idx,
+                    prompt_length=max(prompt_lengths),
+                    batch_size=len(group),
+                ):
+                    sampling_kwargs = dict(
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        repetition_penalty=repetition_penalty,
+                    )
+                    if len(group) == 1:
+                        ys = [
+                            generate(
+                                model=model,
+                                prompt=prompts[0],
+                                decode_one_token=decode_one_token,
+                                **sampling_kwargs,
+                            )
+                        ]
+                    else:
+                        ys = generate_batch(
+                            model=model, prompts=prompts, **sampling_kwargs
+                        )
+
+                    if group[0] == 0 and seg_idx == 0 and compile:
+                        logger.info(
+                            f"Compilation time: {time.perf_counter() - t0:.2f} seconds"
+                        )
+
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+
+                t = time.perf_counter() - t0
+
+                tokens_generated = sum(
+                    y.size(1) - prompt_length
+                    for y, prompt_length in zip(ys, prompt_lengths)
+                )
+                tokens_sec = tokens_generated / t
+                logger.info(
+                    f"Generated {tokens_generated} tokens in {t:.02f} seconds, {tokens_sec:.02f} tokens/sec"
+                )
+                logger.info(
+                    f"Bandwidth achieved: {model_size * tokens_sec / len(group) / 1e9:.02f} GB/s"
+                )
 
-            decoded = y[:, prompt_length:].clone()
-            # But for global encoding, we should keep the <im_end> token
+                if torch.cuda.is_available():
+                    logger.info(
+                        f"GPU Memory used: {torch.cuda.max_memory_reserved() / 1e9:.02f} GB"
+                    )
 
-            global_encoded.append(decoded)
-            assert (codes >= 0).all(), f"Negative code found: {codes}"
-            yield GenerateResponse(action="sample", codes=codes, text=texts[seg_idx])
-            seg_idx += 1
+                for sample_idx, y, prompt_length in zip(group, ys, prompt_lengths):
+                    # Put the generated tokens
+                    # since there is <im_end>, we remove last token
+                    codes = y[1:, prompt_length + 1 :].clone()
+                    assert (codes >= 0).all(), f"Negative code found: {codes}"
+
+                    decoded = y[:, prompt_length:].clone()
+                    # But for global encoding, we should keep the <im_end> token
+
+                    global_encoded[sample_idx].append(decoded)
+                    yield GenerateResponse(
+                        action="sample",
+                        codes=codes,
+                        text=texts[seg_idx],
+                        sample_idx=sample_idx,
+                    )
 
-        # This indicates the end of the current sample
-        yield GenerateResponse(action="next")
+            # This indicates the end of the current samples
+            for sample_idx in group:
+                yield GenerateResponse(action="next", sample_idx=sample_idx)
 
 
 @dataclass
@@ -896,6 +1386,10 @@ class WrappedGenerateResponse:
 class GenerateRequest:
     request: dict
     response_queue: queue.Queue
+    enqueue_time: float = field(default_factory=time.perf_counter)
+    # Tracing context of the caller, the worker thread records its spans there
+    trace: Trace | None = field(default_factory=current_trace.get)
+    parent_span: Span | None = field(default_factory=current_span.get)
 
 
 def launch_thread_safe_queue(
@@ -924,18 +1418,26 @@ def launch_thread_safe_queue(
             if item is None:
                 break
 
+            queue_wait = time.perf_counter() - item.enqueue_time
+            QUEUE_WAIT.observe(queue_wait)
+
             kwargs = item.request
             response_queue = item.response_queue
 
-            try:
-                for chunk in generate_long(
-                    model=model, decode_one_token=decode_one_token, **kwargs
-                ):
+            with use_trace(item.trace, item.parent_span):
+                record_span("llama.queue_wait", queue_wait)
+
+                try:
+                    for chunk in generate_long(
+                        model=model, decode_one_token=decode_one_token, **kwargs
+                    ):
+                        response_queue.put(
+                            WrappedGenerateResponse(status="success", response=chunk)
+                        )
+                except Exception as e:
                     response_queue.put(
-                        WrappedGenerateResponse(status="success", response=chunk)
+                        WrappedGenerateResponse(status="error", response=e)
                     )
-            except Exception as e:
-                response_queue.put(WrappedGenerateResponse(status="error", response=e))
 
     threading.Thread(target=worker, daemon=True).start()
     init_event.wait()
@@ -973,6 +1475,8 @@ def launch_thread_safe_queue_agent(
             if item is None:
                 break
 
+            QUEUE_WAIT.observe(time.perf_counter() - item.enqueue_time)
+
             kwargs = item.request
             response_queue = item.response_queue
 
@@ -1027,6 +1531,29 @@ def launch_thread_safe_queue_agent(
 @click.option("--iterative-prompt/--no-iterative-prompt", default=True)
 @click.option("--chunk-length", type=int, default=100)
 @click.option("--output-dir", type=Path, default="temp")
+@click.option(
+    "--max-prompt-tokens",
+    type=int,
+    default=None,
+    help="Token budget of the reference prompts, no budget by default",
+)
+@click.option(
+    "--prompt-order",
+    type=click.Choice(["given", "shortest", "longest"]),
+    default="given",
+)
+@click.option(
+    "--parallel-segments/--no-parallel-segments",
+    default=False,
+    help="Condition the segments on the references only, and generate them in batches",
+)
+@click.option("--segment-batch-size", type=int, default=4)
+@click.option(
+    "--profile/--no-profile",
+    default=False,
+    help="Write a Chrome trace and a summary of the generation to --profile-dir",
+)
+@click.option("--profile-dir", type=Path, default="profiles")
 def main(
     text: str,
     prompt_text: Optional[list[str]],
@@ -1044,6 +1571,12 @@ def main(
     iterative_prompt: bool,
     chunk_length: int,
     output_dir: Path,
+    max_prompt_tokens: Optional[int],
+    prompt_order: str,
+    parallel_segments: bool,
+    segment_batch_size: int,
+    profile: bool,
+    profile_dir: Path,
 ) -> None:
     os.makedirs(output_dir, exist_ok=True)
     precision = torch.half if half else torch.bfloat16
@@ -1092,25 +1625,34 @@ def main(
         chunk_length=chunk_length,
         prompt_text=prompt_text,
         prompt_tokens=prompt_tokens,
+        max_prompt_tokens=max_prompt_tokens,
+        prompt_order=prompt_order,
+        parallel_segments=parallel_segments,
+        segment_batch_size=segment_batch_size,
     )
 
-    idx = 0
-    codes = []
-
-    for response in generator:
-        if response.action == "sample":
-            codes.append(response.codes)
-            logger.info(f"Sampled text: {response.text}")
-        elif response.action == "next":
-            if codes:
-                codes_npy_path = os.path.join(output_dir, f"codes_{idx}.npy")
-                np.save(codes_npy_path, torch.cat(codes, dim=1).cpu().numpy())
-                logger.info(f"Saved codes to {codes_npy_path}")
-            logger.info(f"Next sample")
-            codes = []
-            idx += 1
-        else:
-            logger.error(f"Error: {response}")
+    # The samples may be generated together, their segments interleaved
+    codes = {}
+
+    profiler = RequestProfiler(profile_dir if profile else None)
+    with profiler.profile("generate_long"):
+        for response in generator:
+            if response.action == "sample":
+                codes.setdefault(response.sample_idx, []).append(response.codes)
+                logger.info(f"Sampled text: {response.text}")
+            elif response.action == "next":
+                sample_codes = codes.pop(response.sample_idx, [])
+                if sample_codes:
+                    codes_npy_path = os.path.join(
+                        output_dir, f"codes_{response.sample_idx}.npy"
+                    )
+                    np.save(
+                        codes_npy_path, torch.cat(sample_codes, dim=1).cpu().numpy()
+                    )
+                    logger.info(f"Saved codes to {codes_npy_path}")
+                logger.info(f"Next sample")
+            else:
+                logger.error(f"Error: {response}")
 
 
 if __name__ == "__main__":
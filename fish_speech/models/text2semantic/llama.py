@@ -143,8 +143,9 @@ class KVCache(nn.Module):
         # input_pos: [S], k_val: [B, H, S, D]
         assert input_pos.shape[0] == k_val.shape[2]
 
-        k_out = self.k_cache
-        v_out = self.v_cache
+        # The cache may be larger than the batch
+        k_out = self.k_cache[: k_val.shape[0]]
+        v_out = self.v_cache[: v_val.shape[0]]
         k_out[:, :, input_pos] = k_val
         v_out[:, :, input_pos] = v_val
 
@@ -317,6 +318,7 @@ class BaseTransformer(nn.Module):
         inp: Tensor,
         input_pos: Optional[Tensor] = None,
         return_all: bool = False,
+        key_mask: Optional[Tensor] = None,
     ) -> BaseTransformerForwardResult:
         x = self.embed(
             inp, share_codebook_embeddings=self.config.share_codebook_embeddings
@@ -329,6 +331,13 @@ class BaseTransformer(nn.Module):
             max_seq_len = self.max_seq_len
 
         mask = self.causal_mask[None, None, input_pos, :max_seq_len]  # (B, N, Q, K)
+        if key_mask is not None:
+            # key_mask: (B, max_seq_len), False on the (left) padding of each sequence
+            # Padding positions only attend to padding, so that no row is fully masked
+            key_mask = key_mask[:, :max_seq_len]
+            mask = mask & (
+                key_mask[:, None, None, :] | ~key_mask[:, None, input_pos, None]
+            )
         freqs_cis = self.freqs_cis[input_pos]
 
         for layer in self.layers:
@@ -663,7 +672,7 @@ class DualARTransformer(BaseTransformer):
         self, x: Tensor, input_pos: Optional[Tensor] = None
     ) -> Tensor:
         # Fast transformer
-        x = x.view(1, 1, -1)
+        x = x.view(x.shape[0], 1, -1)
 
         fast_mask = self.causal_mask[
             None, None, input_pos, : self.config.num_codebooks
@@ -684,8 +693,9 @@ class DualARTransformer(BaseTransformer):
         x: Tensor,
         input_pos: Optional[Tensor] = None,
         vq_masks: Optional[Tensor] = None,
+        key_mask: Optional[Tensor] = None,
     ) -> TransformerForwardResult:
-        x = super().forward_generate(x, input_pos, vq_masks)
+        x = super().forward_generate(x, input_pos, vq_masks, key_mask=key_mask)
         x.hidden_states = self.fast_project_in(x.hidden_states)
         return x
 
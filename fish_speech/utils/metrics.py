@@ -0,0 +1,170 @@
+import threading
+from bisect import bisect_left
+from typing import Callable
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 4)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Histogram:
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...]):
+        """
+        Prometheus histogram: observing is a bisect and two additions under a lock.
+        """
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def render(self) -> list[str]:
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+
+        return lines
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, description: str):
+        """
+        Prometheus gauge, whose values are read from callbacks at scrape time.
+        """
+        self.name = name
+        self.description = description
+        self.callbacks: dict[str, Callable[[], float]] = {}
+
+    def register(self, fn: Callable[[], float], **labels: str) -> None:
+        self.callbacks[format_labels(labels)] = fn
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for labels, fn in list(self.callbacks.items()):
+            lines.append(f"{self.name}{labels} {fn()}")
+
+        return lines
+
+
+class Counter(Gauge):
+    """
+    Prometheus counter, for the monotonic values (e.g. cache hits), read from
+    callbacks at scrape time as well.
+    """
+
+    type = "counter"
+
+
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Histogram | Gauge] = {}
+
+    def histogram(
+        self, name: str, description: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, description, buckets)
+        return self.metrics[name]
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        if name not in self.metrics:
+            self.metrics[name] = Gauge(name, description)
+        return self.metrics[name]
+
+    def counter(self, name: str, description: str) -> Counter:
+        if name not in self.metrics:
+            self.metrics[name] = Counter(name, description)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        """
+        Render all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+QUEUE_WAIT = registry.histogram(
+    "fish_llama_queue_wait_seconds",
+    "Time a generation request waits before the LLAMA worker picks it up",
+)
+PREFILL_TIME = registry.histogram(
+    "fish_llama_prefill_seconds",
+    "Prefill time of each generated segment (on CUDA, detailed traces only)",
+)
+DECODE_TOKEN_TIME = registry.histogram(
+    "fish_llama_decode_token_seconds",
+    "Mean decode time per token of each generated segment",
+    TOKEN_BUCKETS,
+)
+VOCODER_TIME = registry.histogram(
+    "fish_vocoder_seconds", "Time to decode the VQ codes of a segment to audio"
+)
+TIME_TO_FIRST_AUDIO = registry.histogram(
+    "fish_tts_time_to_first_audio_seconds",
+    "Time between a TTS request and its first audio byte",
+)
+REAL_TIME_FACTOR = registry.histogram(
+    "fish_tts_real_time_factor",
+    "Processing time divided by the duration of the generated audio",
+    RATIO_BUCKETS,
+)
+QUEUE_DEPTH = registry.gauge(
+    "fish_queue_depth", "Number of requests waiting for each worker"
+)
+REFERENCE_CACHE = registry.gauge(
+    "fish_reference_cache",
+    "Cache of the uploaded references: entries, bytes, device bytes, max bytes",
+)
+REFERENCE_CACHE_EVENTS = registry.counter(
+    "fish_reference_cache_events_total",
+    "Cache of the uploaded references: hits, misses, evictions, offloads",
+)
+INFLIGHT_REQUESTS = registry.gauge(
+    "fish_tts_inflight_requests",
+    "Inferences shared by identical deterministic TTS requests, in flight",
+)
+INFLIGHT_REQUESTS_EVENTS = registry.counter(
+    "fish_tts_inflight_requests_total",
+    "Deterministic TTS requests which started an inference or were coalesced",
+)
@@ -0,0 +1,203 @@
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+from loguru import logger
+
+from fish_speech.utils.tracing import current_trace
+
+
+class StackSampler:
+
+    def __init__(self, interval: float = 0.005) -> None:
+        """
+        Samples the Python stacks of all the threads every `interval` seconds.
+        Unlike the torch profiler, it sees the Python code between the ops.
+        """
+        self.interval = interval
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+
+                # Root first, as in the collapsed stack format
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self.stacks.clear()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def top(self, n: int = 30) -> list[tuple[str, int, int]]:
+        """
+        Functions with the most samples: (function, self samples, total samples).
+        """
+        self_counts, total_counts = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for function in set(stack):
+                total_counts[function] += count
+
+        return [
+            (function, self_counts[function], total)
+            for function, total in total_counts.most_common(n)
+        ]
+
+    def save_collapsed(self, path: Path) -> None:
+        """
+        Collapsed stacks, readable by flamegraph.pl or speedscope.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+
+class RequestProfiler:
+
+    def __init__(
+        self,
+        output_dir: str | Path | None = None,
+        num_requests: int = 1,
+        request_ids: list[str] | None = None,
+        sample_rate: float = 0.0,
+        stack_interval: float = 0.005,
+        row_limit: int = 30,
+    ) -> None:
+        """
+        Profiles whole requests with the torch profiler and the stack sampler.
+        A request is profiled if its id is in `request_ids`, or with probability
+        `sample_rate`, or else if it is one of the first ones, until `num_requests`
+        requests were profiled. Disabled when `output_dir` is None.
+        Only one request is profiled at a time, the others run as usual.
+        """
+        self.output_dir = Path(output_dir) if output_dir is not None else None
+        self.remaining = num_requests
+        self.request_ids = set(request_ids or [])
+        self.sample_rate = sample_rate
+        self.stack_interval = stack_interval
+        self.row_limit = row_limit
+        self.lock = threading.Lock()
+
+        if self.output_dir is not None:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.output_dir is not None and self.remaining > 0
+
+    def should_profile(self, request_id: str) -> bool:
+        if not self.enabled:
+            return False
+
+        if self.request_ids:
+            return request_id in self.request_ids
+        if self.sample_rate > 0:
+            return random.random() < self.sample_rate
+
+        return True
+
+    @contextmanager
+    def profile(self, request_id: str):
+        if not self.should_profile(request_id):
+            yield False
+            return
+
+        if not self.lock.acquire(blocking=False):
+            # Another request is being profiled
+            yield False
+            return
+
+        try:
+            self.remaining -= 1
+            # Precise timings for the profiled request, see timings_enabled
+            trace = current_trace.get()
+            if trace is not None:
+                trace.detailed = True
+
+            with self._profile(request_id):
+                yield True
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def _profile(self, request_id: str):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        sampler = StackSampler(self.stack_interval)
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+
+        logger.info(f"Profiling request {request_id}")
+        t0 = time.perf_counter()
+        profiler.start()
+        sampler.start()
+
+        try:
+            yield
+        finally:
+            sampler.stop()
+            profiler.stop()
+            self._save(request_id, profiler, sampler, time.perf_counter() - t0)
+
+    def _save(self, request_id, profiler, sampler: StackSampler, duration: float):
+        # The request id may come from a header, keep it a plain file name
+        name = re.sub(r"[^\w.-]", "_", request_id)
+
+        profiler.export_chrome_trace(str(self.output_dir / f"{name}.trace.json"))
+        sampler.save_collapsed(self.output_dir / f"{name}.stacks.txt")
+
+        if torch.cuda.is_available():
+            sort_by = "self_cuda_time_total"
+        else:
+            sort_by = "self_cpu_time_total"
+        ops_table = profiler.key_averages().table(
+            sort_by=sort_by, row_limit=self.row_limit
+        )
+
+        total_samples = max(sum(sampler.stacks.values()), 1)
+        lines = [f"{'self %':>8} {'total %':>8}  function"]
+        for function, self_count, total_count in sampler.top(self.row_limit):
+            lines.append(
+                f"{self_count / total_samples:>8.1%} "
+                f"{total_count / total_samples:>8.1%}  {function}"
+            )
+
+        summary_path = self.output_dir / f"{name}.summary.txt"
+        summary_path.write_text(
+            f"Request {request_id}, {duration:.2f} seconds\n\n"
+            f"Top ops (torch profiler):\n{ops_table}\n\n"
+            f"Top Python functions ({total_samples} stack samples):\n"
+            + "\n".join(lines)
+            + "\n",
+            encoding="utf-8",
+        )
+
+        logger.info(f"Saved the profile of request {request_id} to {self.output_dir}")
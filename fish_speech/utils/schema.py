@@ -4,17 +4,53 @@ import queue
 from dataclasses import dataclass
 from typing import Literal
 
+import numpy as np
 import torch
-from pydantic import BaseModel, Field, conint, conlist, model_validator
+from pydantic import BaseModel, ConfigDict, Field, conint, conlist, model_validator
 from pydantic.functional_validators import SkipValidation
 from typing_extensions import Annotated
 
 from fish_speech.conversation import Message, TextPart, VQPart
 
 
+class ServeNDArray(BaseModel):
+    # Compact alternative to nested lists: dtype, shape and raw little-endian buffer
+    model_config = ConfigDict(ser_json_bytes="base64", val_json_bytes="base64")
+
+    type: Literal["ndarray"] = "ndarray"
+    dtype: str
+    shape: list[int]
+    data: bytes
+
+    @classmethod
+    def from_array(cls, array: np.ndarray | torch.Tensor) -> "ServeNDArray":
+        if isinstance(array, torch.Tensor):
+            array = array.cpu().numpy()
+
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        return cls(dtype=array.dtype.str, shape=list(array.shape), data=array.tobytes())
+
+    def to_array(self) -> np.ndarray:
+        return np.frombuffer(self.data, dtype=np.dtype(self.dtype)).reshape(self.shape)
+
+
+def decode_codes(codes: list | dict | ServeNDArray) -> np.ndarray:
+    """
+    Decode codes sent either as nested lists or as a binary array
+    (a ServeNDArray, or its unpacked msgpack / JSON dict).
+    """
+    if isinstance(codes, ServeNDArray):
+        return codes.to_array()
+
+    if isinstance(codes, dict) and codes.get("type") == "ndarray":
+        return ServeNDArray.model_validate(codes).to_array()
+
+    return np.asarray(codes)
+
+
 class ServeVQPart(BaseModel):
     type: Literal["vq"] = "vq"
-    codes: SkipValidation[list[list[int]]]
+    codes: SkipValidation[list[list[int]] | ServeNDArray]
 
 
 class ServeTextPart(BaseModel):
@@ -77,7 +113,11 @@ class ServeMessage(BaseModel):
                 new_message.parts.append(TextPart(text=part.text))
             elif isinstance(part, ServeVQPart):
                 new_message.parts.append(
-                    VQPart(codes=torch.tensor(part.codes, dtype=torch.int))
+                    VQPart(
+                        codes=torch.from_numpy(
+                            decode_codes(part.codes).astype(np.int32)
+                        )
+                    )
                 )
             else:
                 raise ValueError(f"Unsupported part type: {part}")
@@ -94,19 +134,24 @@ class ServeChatRequest(BaseModel):
     streaming: bool = False
     num_samples: int = 1
     early_stop_threshold: float = 1.0
+    # Send the VQ codes as binary arrays instead of nested lists
+    binary: bool = False
 
 
 class ServeVQGANEncodeRequest(BaseModel):
     # The audio here should be in wav, mp3, etc
     audios: list[bytes]
+    # Return the tokens as binary arrays instead of nested lists
+    binary: bool = False
 
 
 class ServeVQGANEncodeResponse(BaseModel):
-    tokens: SkipValidation[list[list[list[int]]]]
+    tokens: SkipValidation[list[list[list[int]]] | list[ServeNDArray]]
 
 
 class ServeVQGANDecodeRequest(BaseModel):
-    tokens: SkipValidation[list[list[list[int]]]]
+    # Each item is either a nested list or a binary array
+    tokens: SkipValidation[list[list[list[int]] | ServeNDArray]]
 
 
 class ServeVQGANDecodeResponse(BaseModel):
@@ -158,11 +203,30 @@ class ServeReferenceAudio(BaseModel):
         return f"ServeReferenceAudio(text={self.text!r}, audio_size={len(self.audio)})"
 
 
+class ServeReferenceVoiceRequest(BaseModel):
+    references: Annotated[
+        list[ServeReferenceAudio], conlist(ServeReferenceAudio, min_length=1)
+    ]
+
+
+class ServeAddReferenceVoiceRequest(ServeReferenceVoiceRequest):
+    id: str
+
+
+class ServeReferenceVoice(BaseModel):
+    id: str
+    texts: list[str]
+
+
+class ServeReferenceVoiceList(BaseModel):
+    references: list[ServeReferenceVoice]
+
+
 class ServeTTSRequest(BaseModel):
     text: str
     chunk_length: Annotated[int, conint(ge=100, le=300, strict=True)] = 200
     # Audio format
-    format: Literal["wav", "pcm", "mp3"] = "wav"
+    format: Literal["wav", "pcm", "mp3", "opus", "flac"] = "wav"
     # References audios for in-context learning
     references: list[ServeReferenceAudio] = []
     # Reference id
@@ -173,6 +237,9 @@ class ServeTTSRequest(BaseModel):
     use_memory_cache: Literal["on", "off"] = "off"
     # Normalize text for en & zh, this increase stability for numbers
     normalize: bool = True
+    # Condition each segment on the references only, and generate them in batches
+    # Faster for long texts, but the segments do not follow each other's prosody
+    parallel_segments: bool = False
     # not usually used below
     streaming: bool = False
     max_new_tokens: int = 1024
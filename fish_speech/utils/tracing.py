@@ -0,0 +1,237 @@
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Literal
+
+# Request header asking for the timing breakdown in the response
+DEBUG_TIMING_HEADER = "x-debug-timing"
+REQUEST_ID_HEADER = "x-request-id"
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+class Trace:
+
+    def __init__(self, request_id: str | None = None, detailed: bool = False) -> None:
+        """
+        Spans recorded for one request, from any thread.
+        `detailed` when its timings are looked at (returned, exported or profiled),
+        see timings_enabled.
+        """
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id or self.trace_id
+        self.detailed = detailed or exporter is not None
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+
+    def start_span(self, name: str, parent: Span | None = None, **attributes) -> Span:
+        return Span(
+            name=name,
+            span_id=uuid.uuid4().hex[:16],
+            parent_id=parent.span_id if parent is not None else None,
+            start_ns=time.time_ns(),
+            attributes=attributes,
+        )
+
+    def end_span(self, span: Span) -> None:
+        span.end_ns = time.time_ns()
+        with self.lock:
+            self.spans.append(span)
+
+    def breakdown(self) -> dict[str, tuple[float, int]]:
+        """
+        Total duration (ms) and count of the spans, per name, in start order.
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start_ns)
+
+        totals: dict[str, tuple[float, int]] = {}
+        for s in spans:
+            duration, count = totals.get(s.name, (0.0, 0))
+            totals[s.name] = (duration + s.duration_ms, count + 1)
+
+        return totals
+
+    def server_timing(self) -> str:
+        """
+        Format the breakdown as a Server-Timing header value.
+        """
+        return ", ".join(
+            f'{name};dur={duration:.1f};desc="x{count}"'
+            for name, (duration, count) in self.breakdown().items()
+        )
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+
+        return {
+            "trace_id": self.trace_id,
+            "request_id": self.request_id,
+            "spans": [
+                {
+                    "name": s.name,
+                    "span_id": s.span_id,
+                    "parent_id": s.parent_id,
+                    "start_time_ns": s.start_ns,
+                    "end_time_ns": s.end_ns,
+                    "duration_ms": s.duration_ms,
+                    "attributes": s.attributes,
+                }
+                for s in spans
+            ],
+        }
+
+    def to_otlp(self) -> dict:
+        """
+        OpenTelemetry (OTLP/JSON) representation, readable by the OTel collector.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "fish-speech"},
+                            },
+                            {
+                                "key": "request.id",
+                                "value": {"stringValue": self.request_id},
+                            },
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "fish_speech"},
+                            "spans": [
+                                {
+                                    "traceId": self.trace_id,
+                                    "spanId": s.span_id,
+                                    "parentSpanId": s.parent_id or "",
+                                    "name": s.name,
+                                    "kind": 1,
+                                    "startTimeUnixNano": str(s.start_ns),
+                                    "endTimeUnixNano": str(s.end_ns),
+                                    "attributes": [
+                                        {"key": k, "value": {"stringValue": str(v)}}
+                                        for k, v in s.attributes.items()
+                                    ],
+                                }
+                                for s in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+class TraceExporter:
+
+    def __init__(self, path: str | Path, format: Literal["json", "otlp"] = "otlp"):
+        """
+        Append each finished trace to a file, one JSON document per line.
+        """
+        self.path = Path(path)
+        self.format = format
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, trace: Trace) -> None:
+        data = trace.to_otlp() if self.format == "otlp" else trace.to_dict()
+        line = json.dumps(data, ensure_ascii=False)
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+exporter: TraceExporter | None = None
+
+
+def set_exporter(path: str | Path | None, format: Literal["json", "otlp"] = "otlp"):
+    global exporter
+    exporter = TraceExporter(path, format) if path is not None else None
+
+
+def finish_trace(trace: Trace) -> None:
+    if exporter is not None:
+        exporter.export(trace)
+
+
+@contextmanager
+def use_trace(trace: Trace | None, parent: Span | None = None):
+    """
+    Make `trace` the current trace, e.g. in a worker thread picking up a request.
+    """
+    trace_token = current_trace.set(trace)
+    span_token = current_span.set(parent)
+    try:
+        yield trace
+    finally:
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record a span in the current trace, no-op when there is none.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    s = trace.start_span(name, current_span.get(), **attributes)
+    token = current_span.set(s)
+    try:
+        yield s
+    finally:
+        current_span.reset(token)
+        trace.end_span(s)
+
+
+def timings_enabled() -> bool:
+    """
+    Whether the current request needs precise GPU timings.
+    They take a sync, which stalls the pipeline, so only for detailed traces.
+    """
+    trace = current_trace.get()
+    return trace is not None and trace.detailed
+
+
+def record_span(name: str, duration: float, **attributes) -> None:
+    """
+    Record a span that ended now and lasted `duration` seconds.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return
+
+    s = trace.start_span(name, current_span.get(), **attributes)
+    s.end_ns = time.time_ns()
+    s.start_ns = s.end_ns - int(duration * 1e9)
+    with trace.lock:
+        trace.spans.append(s)
@@ -0,0 +1,513 @@
+"""
+Load test of the API server: throughput, time to first byte and latency percentiles.
+
+Closed loop (--rate 0): `--concurrency` clients send requests back to back.
+Open loop (--rate > 0): requests arrive following a Poisson process, whatever the
+server latency, and at most `--concurrency` are in flight (0 for no limit).
+
+The results are saved as JSON and can be compared with a previous run (--baseline).
+Against a server started with a tiny random-weight checkpoint (see
+tools/create_tiny_checkpoint.py), it runs on CPU in CI.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import sys
+import time
+import wave
+from pathlib import Path
+
+import httpx
+import numpy as np
+import ormsgpack
+
+ENDPOINTS = {
+    "tts": "/v1/tts",
+    "vqgan-encode": "/v1/vqgan/encode",
+    "vqgan-decode": "/v1/vqgan/decode",
+    "chat": "/v1/chat",
+}
+
+# Used when no --text-file is given, repeated up to the requested length
+DEFAULT_CORPUS = (
+    "The quick brown fox jumps over the lazy dog. "
+    "She sells sea shells by the sea shore, and the shells she sells are surely seashells. "
+    "In 1492, Columbus sailed the ocean blue with three ships and ninety men. "
+    "Please call Stella and ask her to bring these things with her from the store. "
+)
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Lower is better for these metrics, higher is better for the others
+LOWER_IS_BETTER = ("ttfb", "latency", "error_rate", "real_time_factor")
+# Depend on the workload rather than on the server
+NOT_COMPARED = ("num_requests", "num_errors", "wall_time", "audio_seconds")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the latency and throughput of the API server."
+    )
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    parser.add_argument(
+        "--endpoint", type=str, choices=list(ENDPOINTS.keys()), default="tts"
+    )
+    parser.add_argument("--num-requests", type=int, default=50)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of clients (closed loop) or max in-flight requests (open loop)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Poisson arrival rate in requests/second, 0 for a closed loop",
+    )
+    parser.add_argument("--warmup-requests", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--api-key", type=str, default=None)
+
+    # Text
+    parser.add_argument(
+        "--text-file",
+        type=str,
+        default=None,
+        help="Texts are cut from this file, a built-in corpus is used otherwise",
+    )
+    parser.add_argument(
+        "--text-lengths",
+        type=str,
+        nargs="+",
+        default=["100"],
+        help="Text lengths in characters, with an optional weight (e.g. 50:3 400:1)",
+    )
+
+    # References
+    parser.add_argument("--reference-id", type=str, nargs="+", default=[])
+    parser.add_argument("--reference-audio", type=str, nargs="+", default=[])
+    parser.add_argument("--reference-text", type=str, nargs="+", default=[])
+    parser.add_argument(
+        "--no-reference-ratio",
+        type=float,
+        default=0,
+        help="Fraction of the requests sent without any reference",
+    )
+
+    # TTS
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["wav", "pcm", "mp3", "opus", "flac"],
+        default="wav",
+    )
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--max-new-tokens", type=int, default=1024)
+    parser.add_argument("--chunk-length", type=int, default=200)
+    parser.add_argument("--use-memory-cache", choices=["on", "off"], default="off")
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=44100,
+        help="Sample rate of the pcm outputs and of the VQGAN decoder",
+    )
+
+    # VQGAN
+    parser.add_argument(
+        "--encode-seconds",
+        type=float,
+        default=5,
+        help="Length of the synthetic clip encoded when no --reference-audio is given",
+    )
+    parser.add_argument("--decode-tokens", type=int, default=100)
+    parser.add_argument("--num-codebooks", type=int, default=8)
+    parser.add_argument("--codebook-size", type=int, default=1000)
+
+    # Results
+    parser.add_argument("--output", type=str, default="benchmark.json")
+    parser.add_argument(
+        "--baseline", type=str, default=None, help="Previous results to compare with"
+    )
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        default=0.1,
+        help="Relative change of a metric reported as a regression",
+    )
+
+    return parser.parse_args()
+
+
+def parse_weighted(values: list[str]) -> tuple[list[int], list[float]]:
+    lengths, weights = [], []
+    for value in values:
+        length, _, weight = value.partition(":")
+        lengths.append(int(length))
+        weights.append(float(weight) if weight else 1.0)
+
+    return lengths, weights
+
+
+def synthetic_wav(seconds: float, sample_rate: int, rng: np.random.Generator) -> bytes:
+    """
+    A chirp with some noise, so that the encoder does not see pure silence.
+    """
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = 0.3 * np.sin(2 * np.pi * (200 + 100 * t) * t)
+    audio += 0.01 * rng.standard_normal(len(t))
+    pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm.tobytes())
+
+    return buffer.getvalue()
+
+
+class PayloadFactory:
+
+    def __init__(self, args, rng: random.Random):
+        """
+        Builds the request bodies: texts of random lengths and a mix of references.
+        """
+        self.args = args
+        self.rng = rng
+        self.np_rng = np.random.default_rng(args.seed)
+
+        if args.text_file is not None:
+            self.corpus = Path(args.text_file).read_text(encoding="utf-8")
+        else:
+            self.corpus = DEFAULT_CORPUS
+        self.corpus = " ".join(self.corpus.split())
+        self.lengths, self.length_weights = parse_weighted(args.text_lengths)
+
+        if len(args.reference_audio) != len(args.reference_text):
+            raise ValueError("Each --reference-audio needs a --reference-text")
+
+        self.references = [
+            {"audio": Path(audio).read_bytes(), "text": text}
+            for audio, text in zip(args.reference_audio, args.reference_text)
+        ]
+
+        if self.references:
+            self.encode_audio = self.references[0]["audio"]
+        else:
+            self.encode_audio = synthetic_wav(
+                args.encode_seconds, args.sample_rate, self.np_rng
+            )
+
+    def text(self) -> str:
+        length = self.rng.choices(self.lengths, self.length_weights)[0]
+        repeated = self.corpus * (length // len(self.corpus) + 2)
+        start = self.rng.randrange(len(self.corpus))
+        return repeated[start : start + length].strip()
+
+    def reference(self) -> dict:
+        choices = [{"reference_id": i} for i in self.args.reference_id]
+        choices += [{"references": [ref]} for ref in self.references]
+        if not choices or self.rng.random() < self.args.no_reference_ratio:
+            return {}
+
+        return self.rng.choice(choices)
+
+    def make(self) -> tuple[dict, int]:
+        """
+        Return a request body and its text length.
+        """
+        args = self.args
+
+        if args.endpoint == "tts":
+            text = self.text()
+            body = {
+                "text": text,
+                "format": args.format,
+                "streaming": args.streaming,
+                "max_new_tokens": args.max_new_tokens,
+                "chunk_length": args.chunk_length,
+                "use_memory_cache": args.use_memory_cache,
+                **self.reference(),
+            }
+            return body, len(text)
+
+        if args.endpoint == "chat":
+            text = self.text()
+            body = {
+                "messages": [
+                    {"role": "user", "parts": [{"type": "text", "text": text}]}
+                ],
+                "max_new_tokens": args.max_new_tokens,
+                "streaming": False,
+                "binary": True,
+            }
+            return body, len(text)
+
+        if args.endpoint == "vqgan-encode":
+            return {"audios": [self.encode_audio], "binary": True}, 0
+
+        codes = self.np_rng.integers(
+            0, args.codebook_size, (args.num_codebooks, args.decode_tokens)
+        ).astype("<i2")
+        body = {
+            "tokens": [
+                {
+                    "type": "ndarray",
+                    "dtype": codes.dtype.str,
+                    "shape": list(codes.shape),
+                    "data": codes.tobytes(),
+                }
+            ]
+        }
+        return body, 0
+
+
+def audio_seconds(args, body: bytes) -> float | None:
+    """
+    Duration of the returned audio, for the uncompressed outputs only.
+    """
+    if args.endpoint == "vqgan-decode":
+        audios = ormsgpack.unpackb(body)["audios"]
+        # PCM float16
+        return sum(len(audio) / 2 for audio in audios) / args.sample_rate
+
+    if args.endpoint != "tts":
+        return None
+
+    # The server streams wav as raw int16 PCM, without a header
+    if args.format == "pcm" or (args.format == "wav" and args.streaming):
+        return len(body) / 2 / args.sample_rate
+
+    if args.format != "wav":
+        return None
+
+    with wave.open(io.BytesIO(body), "rb") as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+async def send_request(
+    client: httpx.AsyncClient, args, payload: dict, text_length: int
+) -> dict:
+    result = {
+        "text_length": text_length,
+        "ok": False,
+        "status": None,
+        "error": None,
+        "ttfb": None,
+        "latency": None,
+        "audio_seconds": None,
+        "bytes": 0,
+    }
+
+    content = ormsgpack.packb(payload)
+    start = time.perf_counter()
+
+    try:
+        async with client.stream(
+            "POST", ENDPOINTS[args.endpoint], content=content
+        ) as response:
+            chunks = []
+            async for chunk in response.aiter_bytes():
+                if result["ttfb"] is None:
+                    result["ttfb"] = time.perf_counter() - start
+                chunks.append(chunk)
+
+        result["latency"] = time.perf_counter() - start
+        result["status"] = response.status_code
+        body = b"".join(chunks)
+        result["bytes"] = len(body)
+
+        if response.status_code != 200:
+            result["error"] = f"HTTP {response.status_code}"
+            return result
+
+        result["audio_seconds"] = audio_seconds(args, body)
+        result["ok"] = True
+    except httpx.HTTPError as e:
+        result["latency"] = time.perf_counter() - start
+        result["error"] = type(e).__name__
+    except (ormsgpack.MsgpackDecodeError, wave.Error, EOFError, KeyError) as e:
+        # A malformed body fails this request, not the whole run
+        result["error"] = type(e).__name__
+
+    return result
+
+
+async def closed_loop(client, args, factory: PayloadFactory) -> list[dict]:
+    results = []
+    remaining = iter(range(args.num_requests))
+
+    async def worker():
+        for _ in remaining:
+            payload, text_length = factory.make()
+            results.append(await send_request(client, args, payload, text_length))
+
+    await asyncio.gather(*(worker() for _ in range(max(args.concurrency, 1))))
+
+    return results
+
+
+async def open_loop(client, args, factory: PayloadFactory, rng) -> list[dict]:
+    semaphore = asyncio.Semaphore(args.concurrency) if args.concurrency > 0 else None
+
+    async def scheduled(payload, text_length):
+        arrival = time.perf_counter()
+        if semaphore is None:
+            result = await send_request(client, args, payload, text_length)
+        else:
+            async with semaphore:
+                result = await send_request(client, args, payload, text_length)
+
+        # Time spent waiting for a free slot counts, as for a real user
+        result["client_queue_wait"] = time.perf_counter() - arrival - result["latency"]
+        return result
+
+    tasks = []
+    for _ in range(args.num_requests):
+        payload, text_length = factory.make()
+        tasks.append(asyncio.create_task(scheduled(payload, text_length)))
+        await asyncio.sleep(rng.expovariate(args.rate))
+
+    return list(await asyncio.gather(*tasks))
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+
+    summary = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    summary["mean"] = float(np.mean(values))
+    summary["max"] = float(np.max(values))
+
+    return summary
+
+
+def summarize(results: list[dict], wall_time: float) -> dict:
+    ok = [r for r in results if r["ok"]]
+    errors: dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    durations = [r["audio_seconds"] for r in ok if r["audio_seconds"] is not None]
+    total_audio = float(sum(durations))
+
+    summary = {
+        "num_requests": len(results),
+        "num_errors": len(results) - len(ok),
+        "error_rate": (len(results) - len(ok)) / max(len(results), 1),
+        "errors": errors,
+        "wall_time": wall_time,
+        "requests_per_second": len(ok) / wall_time,
+        "ttfb": percentiles([r["ttfb"] for r in ok if r["ttfb"] is not None]),
+        "latency": percentiles([r["latency"] for r in ok]),
+    }
+
+    if durations:
+        summary["audio_seconds"] = total_audio
+        summary["audio_seconds_per_wall_second"] = total_audio / wall_time
+        summary["real_time_factor"] = percentiles(
+            [r["latency"] / r["audio_seconds"] for r in ok if r["audio_seconds"]]
+        )
+
+    return summary
+
+
+def flatten(summary: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            if key != "errors":
+                flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+
+    return flat
+
+
+def compare(summary: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Print the relative change of each metric, and return the regressions.
+    """
+    current, previous = flatten(summary), flatten(baseline)
+    regressions = []
+
+    print(f"{'metric':<40}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, value in current.items():
+        if key not in previous or key in NOT_COMPARED:
+            continue
+
+        before = previous[key]
+        change = (value - before) / before if before else 0.0
+        if key.startswith(LOWER_IS_BETTER):
+            worse = change > threshold
+        else:
+            worse = change < -threshold
+
+        flag = "  <-- regression" if worse else ""
+        print(f"{key:<40}{before:>12.4f}{value:>12.4f}{change:>+10.1%}{flag}")
+        if worse:
+            regressions.append(key)
+
+    return regressions
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    factory = PayloadFactory(args, rng)
+
+    headers = {"content-type": "application/msgpack"}
+    if args.api_key is not None:
+        headers["authorization"] = f"Bearer {args.api_key}"
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(
+        base_url=args.url, headers=headers, timeout=args.timeout, limits=limits
+    ) as client:
+        # Compilation, lazy loading and caches should not count
+        for _ in range(args.warmup_requests):
+            payload, text_length = factory.make()
+            await send_request(client, args, payload, text_length)
+
+        start = time.perf_counter()
+        if args.rate > 0:
+            results = await open_loop(client, args, factory, rng)
+        else:
+            results = await closed_loop(client, args, factory)
+        wall_time = time.perf_counter() - start
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("api_key", "baseline", "output")
+    }
+
+    return {
+        "config": config,
+        "summary": summarize(results, wall_time),
+        "requests": results,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+
+    print(json.dumps(report["summary"], indent=2))
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"Results saved to {args.output}")
+
+    if args.baseline is not None:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare(
+            report["summary"], baseline["summary"], args.regression_threshold
+        )
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
@@ -66,7 +66,7 @@ def parse_args():
         help="Whether to play audio after receiving data",
     )
     parser.add_argument(
-        "--format", type=str, choices=["wav", "mp3", "flac"], default="wav"
+        "--format", type=str, choices=["wav", "mp3", "flac", "opus"], default="wav"
     )
     parser.add_argument(
         "--latency",
@@ -111,6 +111,11 @@ def parse_args():
         choices=["on", "off"],
         help="Cache encoded references codes in memory.\n",
     )
+    parser.add_argument(
+        "--parallel_segments",
+        action="store_true",
+        help="Generate the segments independently, in batches (faster for long texts)",
+    )
     parser.add_argument(
         "--seed",
         type=int,
@@ -167,6 +172,7 @@ if __name__ == "__main__":
         "temperature": args.temperature,
         "streaming": args.streaming,
         "use_memory_cache": args.use_memory_cache,
+        "parallel_segments": args.parallel_segments,
         "seed": args.seed,
     }
 
@@ -183,7 +189,17 @@ if __name__ == "__main__":
     )
 
     if response.status_code == 200:
-        if args.streaming:
+        if args.streaming and args.format != "wav":
+            # Compressed streams are written as they arrive
+            audio_path = f"{args.output}.{args.format}"
+            with open(audio_path, "wb") as audio_file:
+                for chunk in response.iter_content(chunk_size=1024):
+                    audio_file.write(chunk)
+
+            if args.play:
+                play(AudioSegment.from_file(audio_path, format=args.format))
+            print(f"Audio has been saved to '{audio_path}'.")
+        elif args.streaming:
             p = pyaudio.PyAudio()
             audio_format = pyaudio.paInt16  # Assuming 16-bit PCM format
             stream = p.open(
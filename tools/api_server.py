@@ -1,4 +1,5 @@
 import re
+from functools import partial
 from threading import Lock
 
 import pyrootutils
@@ -20,9 +21,20 @@ from typing_extensions import Annotated
 
 pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
 
+from fish_speech.utils.metrics import (
+    INFLIGHT_REQUESTS,
+    INFLIGHT_REQUESTS_EVENTS,
+    QUEUE_DEPTH,
+    REFERENCE_CACHE,
+    REFERENCE_CACHE_EVENTS,
+)
+from fish_speech.utils.profiler import RequestProfiler
+from fish_speech.utils.tracing import set_exporter
 from tools.server.api_utils import MsgPackRequest, parse_args
+from tools.server.batcher import MicroBatcher
 from tools.server.exception_handler import ExceptionHandler
 from tools.server.model_manager import ModelManager
+from tools.server.model_utils import batch_vqgan_decode, cached_vqgan_batch_encode
 from tools.server.views import routes
 
 
@@ -75,6 +87,17 @@ class API(ExceptionHandler):
         self.app.state.device = self.args.device
         self.app.state.max_text_length = self.args.max_text_length
 
+        # Profile a few TTS requests, when enabled
+        self.app.state.profiler = RequestProfiler(
+            self.args.profile_dir if self.args.profile else None,
+            num_requests=self.args.profile_requests,
+            request_ids=self.args.profile_request_id,
+            sample_rate=self.args.profile_sample_rate,
+        )
+
+        # Export the spans of each TTS request
+        set_exporter(self.args.trace_file, self.args.trace_format)
+
         # Associate the app with the model manager
         self.app.on_startup(self.initialize_app)
 
@@ -89,7 +112,61 @@ class API(ExceptionHandler):
             llama_checkpoint_path=self.args.llama_checkpoint_path,
             decoder_checkpoint_path=self.args.decoder_checkpoint_path,
             decoder_config_name=self.args.decoder_config_name,
+            code_cache_dir=self.args.code_cache_dir,
+            code_cache_memory_mb=self.args.code_cache_memory_mb,
+            memory_high_watermark=self.args.memory_high_watermark,
+            memory_trim_interval=self.args.memory_trim_interval,
+            memory_arena_max_batch_size=self.args.memory_arena_max_batch_size,
+            memory_arena_max_seq_len=self.args.memory_arena_max_seq_len,
+            voice_store_dir=self.args.voice_store_dir,
+            voice_store_memory_voices=self.args.voice_store_memory_voices,
+            reference_cache_mb=self.args.reference_cache_mb,
+            reference_cache_device_mb=self.args.reference_cache_device_mb,
+            reference_max_tokens=self.args.reference_max_tokens,
+            reference_order=self.args.reference_order,
+            segment_batch_size=self.args.segment_batch_size,
+        )
+
+        # Coalesce the concurrent VQGAN requests into batches
+        decoder_model = app.state.model_manager.decoder_model
+        decoder_lock = app.state.model_manager.tts_inference_engine.decoder_lock
+        app.state.vqgan_encode_batcher = MicroBatcher(
+            partial(cached_vqgan_batch_encode, decoder_model, lock=decoder_lock),
+            max_batch_size=self.args.vqgan_max_batch_size,
+            window_ms=self.args.vqgan_batch_window_ms,
+        )
+        app.state.vqgan_decode_batcher = MicroBatcher(
+            partial(batch_vqgan_decode, decoder_model, lock=decoder_lock),
+            max_batch_size=self.args.vqgan_max_batch_size,
+            max_batch_cost=self.args.vqgan_max_batch_tokens,
+            window_ms=self.args.vqgan_batch_window_ms,
+            cost_fn=lambda feature: feature.shape[-1],
+        )
+
+        # Queue depth of each worker, read when /v1/metrics is scraped
+        QUEUE_DEPTH.register(app.state.model_manager.llama_queue.qsize, worker="llama")
+        QUEUE_DEPTH.register(
+            lambda: len(app.state.vqgan_encode_batcher.pending), worker="vqgan_encode"
+        )
+        QUEUE_DEPTH.register(
+            lambda: len(app.state.vqgan_decode_batcher.pending), worker="vqgan_decode"
         )
+        reference_cache = app.state.model_manager.tts_inference_engine.ref_by_hash
+        for name in reference_cache.stats():
+            metric = (
+                REFERENCE_CACHE_EVENTS
+                if name in reference_cache.COUNTERS
+                else REFERENCE_CACHE
+            )
+            metric.register(lambda name=name: reference_cache.stats()[name], stat=name)
+        inflight = app.state.model_manager.tts_inference_engine.inflight
+        for name in inflight.stats():
+            metric = (
+                INFLIGHT_REQUESTS_EVENTS
+                if name in inflight.COUNTERS
+                else INFLIGHT_REQUESTS
+            )
+            metric.register(lambda name=name: inflight.stats()[name], stat=name)
 
         logger.info(f"Startup done, listening server at http://{self.args.listen}")
 
@@ -0,0 +1,537 @@
+"""
+Synthesize a manifest of texts offline, resumable:
+    python tools/bulk_synthesize.py manifest.jsonl --output-dir outputs --num-workers 2
+
+The manifest is a JSONL or CSV file with an "id", a "text" and an optional "voice"
+(a reference id, as in references/<voice>) per line.
+Audio is written to <output-dir>/<shard>/<id>.wav, the shard being the first two
+hex digits of the sha1 of the id. Finished ids are appended to
+<output-dir>/progress/rank-<rank>.log, a restarted job skips them.
+
+The segments of several lines (and voices) are generated together with the batched
+decoder, while the vocoder of the previous batch runs in another thread.
+With --num-workers, one worker is spawned per GPU (or CPU share), as extract_vq does.
+"""
+
+import csv
+import json
+import os
+import queue
+import re
+import subprocess as sp
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from hashlib import sha1
+from pathlib import Path
+
+import click
+import pyrootutils
+import soundfile as sf
+import torch
+from loguru import logger
+
+pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from fish_speech.inference_engine import TTSInferenceEngine
+from fish_speech.inference_engine.voice_store import VoiceStore
+from fish_speech.models.text2semantic.inference import (
+    build_context,
+    encode_reference_prompts,
+    encode_system_prompt,
+    encode_tokens,
+    generate,
+    generate_batch,
+    grow_batch_caches,
+    load_model,
+)
+from fish_speech.models.text2semantic.llama import DualARTransformer
+from fish_speech.models.vqgan.inference import load_model as load_decoder_model
+from fish_speech.text import split_text
+from tools.server.model_utils import batch_vqgan_decode
+
+RANK = int(os.environ.get("SLURM_PROCID", 0))
+WORLD_SIZE = int(os.environ.get("SLURM_NTASKS", 1))
+MAX_LENGTH = 4096
+
+logger_format = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
+    "{extra[rank]} - <level>{message}</level>"
+)
+logger.configure(extra={"rank": f"RANK: {RANK} / {WORLD_SIZE}"})
+logger.remove()
+logger.add(sys.stderr, format=logger_format)
+
+
+def load_manifest(path: Path) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        if path.suffix == ".csv":
+            items = list(csv.DictReader(f))
+        else:
+            items = [json.loads(line) for line in f if line.strip()]
+
+    for item in items:
+        item["id"] = str(item["id"])
+        item["voice"] = item.get("voice") or None
+
+    return items
+
+
+def load_done(progress_dir: Path) -> set[str]:
+    """
+    Ids finished by any worker of any previous run.
+    """
+    done = set()
+    for log in progress_dir.glob("*.log"):
+        with open(log, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["id"])
+                except ValueError:
+                    # Last line of an interrupted run
+                    continue
+
+    return done
+
+
+def output_path(output_dir: Path, item_id: str, format: str) -> Path:
+    shard = sha1(item_id.encode("utf-8")).hexdigest()[:2]
+    # The id may be anything, keep it a plain file name
+    name = re.sub(r"[^\w.-]", "_", item_id)
+
+    return output_dir / shard / f"{name}.{format}"
+
+
+class Vocoder:
+
+    def __init__(
+        self,
+        decoder_model,
+        output_dir: Path,
+        format: str,
+        progress_log: Path,
+        num_writers: int = 4,
+        decoder_lock: threading.RLock | None = None,
+    ) -> None:
+        """
+        Decodes the codes of finished lines and writes their audio, in a thread,
+        so that the LLAMA model keeps generating meanwhile.
+        `decoder_lock` is held while decoding, the references are encoded
+        on the same model.
+        """
+        self.decoder_model = decoder_model
+        self.decoder_lock = decoder_lock
+        self.output_dir = output_dir
+        self.format = format
+        self.sample_rate = decoder_model.spec_transform.sample_rate
+        self.queue = queue.Queue(maxsize=2)
+        self.writers = ThreadPoolExecutor(max_workers=num_writers)
+        self.progress = open(progress_log, "a", encoding="utf-8")
+        self.progress_lock = threading.Lock()
+        self.audio_seconds = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, items: list[dict], codes: list[torch.Tensor]) -> None:
+        self.queue.put((items, codes))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        self.writers.shutdown(wait=True)
+        self.progress.close()
+
+    @torch.inference_mode()
+    def _run(self) -> None:
+        while (batch := self.queue.get()) is not None:
+            items, codes = batch
+
+            # No audio for these, e.g. the model ended the text right away
+            empty = [item["id"] for item, c in zip(items, codes) if c.shape[-1] == 0]
+            if empty:
+                logger.error(f"No codes generated for {', '.join(empty)}")
+                kept = [i for i, c in enumerate(codes) if c.shape[-1] > 0]
+                items, codes = [items[i] for i in kept], [codes[i] for i in kept]
+            if not items:
+                continue
+
+            try:
+                audios = batch_vqgan_decode(
+                    self.decoder_model, codes, lock=self.decoder_lock
+                )
+            except Exception as e:
+                # Keep the thread alive, the items are not logged as done
+                # and the next run retries them
+                ids = ", ".join(item["id"] for item in items)
+                logger.error(f"Failed to decode {ids}: {e}")
+                continue
+
+            for item, audio in zip(items, audios):
+                self.writers.submit(self._write, item, audio.squeeze())
+
+    def _write(self, item: dict, audio) -> None:
+        try:
+            self._save(item, audio)
+        except Exception as e:
+            # Not logged as done, the next run retries it
+            logger.error(f"Failed to write {item['id']}: {e}")
+
+    def _save(self, item: dict, audio) -> None:
+        path = output_path(self.output_dir, item["id"], self.format)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Complete files only, the id is logged after the rename
+        tmp_path = path.with_name(f".{path.name}")
+        sf.write(tmp_path, audio, self.sample_rate, format=self.format)
+        os.replace(tmp_path, path)
+
+        duration = len(audio) / self.sample_rate
+        with self.progress_lock:
+            self.audio_seconds += duration
+            self.progress.write(
+                json.dumps({"id": item["id"], "path": str(path), "duration": duration})
+                + "\n"
+            )
+            self.progress.flush()
+
+
+class Synthesizer:
+
+    def __init__(
+        self,
+        llama_model,
+        decode_one_token,
+        decoder_model,
+        device: str,
+        batch_size: int,
+        chunk_length: int,
+        max_new_tokens: int,
+        max_prompt_tokens: int | None,
+        voice_store_dir: str | None,
+        **sampling_kwargs,
+    ) -> None:
+        self.model = llama_model
+        self.decode_one_token = decode_one_token
+        self.device = device
+        self.batch_size = batch_size
+        self.chunk_length = chunk_length
+        self.max_new_tokens = max_new_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.sampling_kwargs = {
+            name: torch.tensor(value, device=device, dtype=torch.float)
+            for name, value in sampling_kwargs.items()
+        }
+
+        # Only used to load the reference voices
+        self.reference_loader = TTSInferenceEngine(
+            llama_queue=None,
+            decoder_model=decoder_model,
+            precision=next(decoder_model.parameters()).dtype,
+            compile=False,
+            voice_store=VoiceStore(voice_store_dir),
+        )
+        self.system_prompt = encode_system_prompt(
+            llama_model.tokenizer, device, llama_model.config.num_codebooks
+        )
+        self.voice_prompts: dict[str | None, list[torch.Tensor]] = {}
+
+        self.batched = isinstance(llama_model, DualARTransformer) and batch_size > 1
+        if self.batched:
+            grow_batch_caches(llama_model, device, batch_size)
+
+    def get_voice_prompts(self, voice: str | None) -> list[torch.Tensor]:
+        if voice in self.voice_prompts:
+            return self.voice_prompts[voice]
+
+        prompts = [self.system_prompt]
+        if voice is not None:
+            prompt_tokens, prompt_texts = self.reference_loader.load_by_id(voice, "on")
+            prompts += encode_reference_prompts(
+                self.model.tokenizer,
+                prompt_text=prompt_texts,
+                prompt_tokens=prompt_tokens,
+                max_tokens=self.max_prompt_tokens,
+                device=self.device,
+                num_codebooks=self.model.config.num_codebooks,
+            )
+
+        self.voice_prompts[voice] = prompts
+        return prompts
+
+    def build_prompts(self, item: dict) -> list[torch.Tensor]:
+        texts = [item["text"]]
+        if self.chunk_length > 0:
+            texts = split_text(item["text"], self.chunk_length) or texts
+        voice_prompts = self.get_voice_prompts(item["voice"])
+
+        # The segments of a line are independent, as in the parallel segments mode
+        return [
+            build_context(
+                [
+                    encode_tokens(
+                        self.model.tokenizer,
+                        string=text,
+                        device=self.device,
+                        num_codebooks=self.model.config.num_codebooks,
+                    )
+                ],
+                voice_prompts,
+                max_length=MAX_LENGTH,
+                use_prompt=item["voice"] is not None,
+            )
+            for text in texts
+        ]
+
+    @torch.inference_mode()
+    def __call__(self, items: list[dict]) -> list[torch.Tensor | None]:
+        """
+        Semantic codes of each line, the segments of all the lines are batched.
+        None for the lines which failed, e.g. with an unknown voice.
+        """
+        segments = []
+        for item_idx, item in enumerate(items):
+            try:
+                prompts = self.build_prompts(item)
+            except ValueError as e:
+                # Not logged as done, the next run retries it
+                logger.error(f"Skipping {item['id']}: {e}")
+                continue
+
+            segments += [
+                (item_idx, seg_idx, prompt) for seg_idx, prompt in enumerate(prompts)
+            ]
+        # Prompts of similar lengths together, less padding
+        segments.sort(key=lambda segment: segment[2].size(1))
+
+        step = self.batch_size if self.batched else 1
+        codes = [{} for _ in items]
+        for start in range(0, len(segments), step):
+            batch = segments[start : start + step]
+            prompts = [prompt for _, _, prompt in batch]
+
+            if len(prompts) == 1:
+                ys = [
+                    generate(
+                        model=self.model,
+                        prompt=prompts[0],
+                        max_new_tokens=self.max_new_tokens,
+                        decode_one_token=self.decode_one_token,
+                        **self.sampling_kwargs,
+                    )
+                ]
+            else:
+                ys = generate_batch(
+                    model=self.model,
+                    prompts=prompts,
+                    max_new_tokens=self.max_new_tokens,
+                    **self.sampling_kwargs,
+                )
+
+            for (item_idx, seg_idx, prompt), y in zip(batch, ys):
+                # Without the <im_end> token
+                codes[item_idx][seg_idx] = y[1:, prompt.size(1) + 1 :]
+
+        return [
+            (
+                torch.cat([item_codes[i] for i in range(len(item_codes))], dim=1)
+                if item_codes
+                else None
+            )
+            for item_codes in codes
+        ]
+
+
+def spawn_workers(num_workers: int) -> None:
+    if torch.cuda.is_available():
+        visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES", None)
+        if visible_devices is None:
+            visible_devices = list(range(torch.cuda.device_count()))
+        else:
+            visible_devices = visible_devices.split(",")
+    else:
+        # Set to empty string to avoid using GPU
+        visible_devices = [""]
+
+    processes = []
+    for i in range(num_workers):
+        env = os.environ.copy()
+        env["CUDA_VISIBLE_DEVICES"] = str(visible_devices[i % len(visible_devices)])
+        env["SLURM_PROCID"] = str(i)
+        env["SLURM_NTASKS"] = str(num_workers)
+        if not torch.cuda.is_available():
+            # Share the cores between the workers
+            env["OMP_NUM_THREADS"] = str(max(os.cpu_count() // num_workers, 1))
+
+        processes.append(sp.Popen([sys.executable] + sys.argv.copy(), env=env))
+
+    for p in processes:
+        p.wait()
+
+
+@click.command()
+@click.argument("manifest", type=click.Path(path_type=Path, exists=True))
+@click.option("--output-dir", type=Path, default="outputs")
+@click.option(
+    "--num-workers",
+    type=int,
+    default=None,
+    help="Worker processes, one per GPU by default",
+)
+@click.option(
+    "--llama-checkpoint-path",
+    type=click.Path(path_type=Path, exists=True),
+    default="checkpoints/fish-speech-1.5",
+)
+@click.option(
+    "--decoder-checkpoint-path",
+    type=click.Path(path_type=Path, exists=True),
+    default="checkpoints/fish-speech-1.5/firefly-gan-vq-fsq-8x1024-21hz-generator.pth",
+)
+@click.option("--decoder-config-name", type=str, default="firefly_gan_vq")
+@click.option("--half/--no-half", default=False)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=8,
+    help="Segments generated together, across lines and voices",
+)
+@click.option(
+    "--lines-per-step",
+    type=int,
+    default=64,
+    help="Lines read ahead, their segments are sorted by length before batching",
+)
+@click.option("--chunk-length", type=int, default=200)
+@click.option("--max-new-tokens", type=int, default=1024)
+@click.option(
+    "--max-prompt-tokens",
+    type=int,
+    default=None,
+    help="Token budget of the reference prompts, no budget by default",
+)
+@click.option("--top-p", type=float, default=0.7)
+@click.option("--repetition-penalty", type=float, default=1.2)
+@click.option("--temperature", type=float, default=0.7)
+@click.option("--seed", type=int, default=42)
+@click.option("--format", type=click.Choice(["wav", "flac"]), default="wav")
+@click.option(
+    "--voice-store-dir",
+    type=str,
+    default=None,
+    help="Reuse (and persist) the encoded reference voices",
+)
+def main(
+    manifest: Path,
+    output_dir: Path,
+    num_workers: int | None,
+    llama_checkpoint_path: Path,
+    decoder_checkpoint_path: Path,
+    decoder_config_name: str,
+    half: bool,
+    batch_size: int,
+    lines_per_step: int,
+    chunk_length: int,
+    max_new_tokens: int,
+    max_prompt_tokens: int | None,
+    top_p: float,
+    repetition_penalty: float,
+    temperature: float,
+    seed: int,
+    format: str,
+    voice_store_dir: str | None,
+):
+    if num_workers is None:
+        num_workers = max(torch.cuda.device_count(), 1)
+
+    if num_workers > 1 and WORLD_SIZE != num_workers:
+        assert WORLD_SIZE == 1, "You should either use SLURM or this launcher, not both"
+
+        logger.info(f"Spawning {num_workers} workers")
+        spawn_workers(num_workers)
+        logger.info(f"All workers finished")
+        return
+
+    # This is a worker
+    progress_dir = output_dir / "progress"
+    progress_dir.mkdir(parents=True, exist_ok=True)
+
+    items = load_manifest(manifest)
+    done = load_done(progress_dir)
+    items = [item for item in items if item["id"] not in done]
+    total_items = len(items)
+    items = items[RANK::WORLD_SIZE]
+    logger.info(
+        f"Processing {len(items)}/{total_items} lines, {len(done)} already done"
+    )
+    if not items:
+        return
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = torch.half if half else torch.bfloat16
+    torch.manual_seed(seed + RANK)
+
+    llama_model, decode_one_token = load_model(llama_checkpoint_path, device, precision)
+    with torch.device(device):
+        llama_model.setup_caches(
+            max_batch_size=1,
+            max_seq_len=llama_model.config.max_seq_len,
+            dtype=next(llama_model.parameters()).dtype,
+        )
+    decoder_model = load_decoder_model(
+        decoder_config_name, decoder_checkpoint_path, device=device
+    )
+
+    synthesizer = Synthesizer(
+        llama_model,
+        decode_one_token,
+        decoder_model,
+        device=device,
+        batch_size=batch_size,
+        chunk_length=chunk_length,
+        max_new_tokens=max_new_tokens,
+        max_prompt_tokens=max_prompt_tokens,
+        voice_store_dir=voice_store_dir,
+        top_p=top_p,
+        repetition_penalty=repetition_penalty,
+        temperature=temperature,
+    )
+    vocoder = Vocoder(
+        decoder_model,
+        output_dir,
+        format,
+        progress_dir / f"rank-{RANK}.log",
+        decoder_lock=synthesizer.reference_loader.decoder_lock,
+    )
+
+    begin_time = time.time()
+    try:
+        for idx in range(0, len(items), lines_per_step):
+            step_items = items[idx : idx + lines_per_step]
+            step_codes = synthesizer(step_items)
+            vocoder.submit(
+                [item for item, c in zip(step_items, step_codes) if c is not None],
+                [c for c in step_codes if c is not None],
+            )
+
+            processed = idx + len(step_items)
+            eta = (time.time() - begin_time) / processed * (len(items) - processed)
+            logger.info(
+                f"Generated {processed}/{len(items)} lines, "
+                f"{vocoder.audio_seconds / 3600:.2f} hours of audio written, "
+                f"ETA: {timedelta(seconds=round(eta))}"
+            )
+    finally:
+        vocoder.close()
+
+    logger.info(
+        f"Finished {len(items)} lines, {vocoder.audio_seconds / 3600:.2f} hours "
+        f"of audio in {timedelta(seconds=round(time.time() - begin_time))}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Build a tiny randomly initialized checkpoint, in the layout of the real one:
+    <output>/config.json, model.pth, tokenizer.tiktoken, special_tokens.json
+    <output>/firefly-gan-vq-fsq-8x1024-21hz-generator.pth
+
+The API server, the WebUI and the benchmarks can then run offline on CPU:
+    python tools/api_server.py --device cpu \
+        --llama-checkpoint-path checkpoints/fish-speech-tiny \
+        --decoder-checkpoint-path checkpoints/fish-speech-tiny/firefly-gan-vq-fsq-8x1024-21hz-generator.pth \
+        --decoder-config-name firefly_gan_vq_tiny
+
+The outputs are random noise, only the shapes and the speed are meaningful.
+"""
+
+import base64
+from pathlib import Path
+
+import click
+import hydra
+import torch
+from hydra import compose, initialize
+from hydra.utils import instantiate
+from loguru import logger
+
+from fish_speech.models.text2semantic.llama import (
+    DualARModelArgs,
+    DualARTransformer,
+    find_multiple,
+)
+from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+from fish_speech.tokenizer import ALL_SPECIAL_TOKENS, FishTokenizer
+
+DECODER_FILENAME = "firefly-gan-vq-fsq-8x1024-21hz-generator.pth"
+
+# Same layout as the real model (8 codebooks of 1024 codes), much smaller layers
+TINY_LLAMA_ARGS = dict(
+    n_layer=2,
+    n_head=4,
+    n_local_heads=2,
+    dim=128,
+    max_seq_len=4096,
+    codebook_size=1024,
+    num_codebooks=8,
+    n_fast_layer=2,
+    use_gradient_checkpointing=False,
+)
+
+
+def build_tokenizer(path: str | Path) -> FishTokenizer:
+    """
+    Byte-level vocabulary: no merges, the special tokens come after the 256 bytes.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        "".join(f"{base64.b64encode(bytes([i])).decode()} {i}\n" for i in range(256))
+    )
+
+    return FishTokenizer(str(path))
+
+
+def build_llama(
+    tokenizer: FishTokenizer, seed: int = 0, **overrides
+) -> DualARTransformer:
+    vocab_size = find_multiple(256 + len(ALL_SPECIAL_TOKENS), 64)
+    config = DualARModelArgs(
+        **{**TINY_LLAMA_ARGS, "vocab_size": vocab_size, **overrides}
+    )
+
+    torch.manual_seed(seed)
+    model = DualARTransformer(config, tokenizer=tokenizer)
+
+    return model.eval()
+
+
+def build_decoder(
+    config_name: str = "firefly_gan_vq_tiny", seed: int = 0
+) -> FireflyArchitecture:
+    hydra.core.global_hydra.GlobalHydra.instance().clear()
+    with initialize(version_base="1.3", config_path="../fish_speech/configs"):
+        cfg = compose(config_name=config_name)
+
+    torch.manual_seed(seed)
+    model = instantiate(cfg)
+
+    return model.eval()
+
+
+@click.command()
+@click.option("--output", type=Path, default="checkpoints/fish-speech-tiny")
+@click.option("--decoder-config-name", type=str, default="firefly_gan_vq_tiny")
+@click.option("--seed", type=int, default=0)
+@click.option("--n-layer", type=int, default=TINY_LLAMA_ARGS["n_layer"])
+@click.option("--n-head", type=int, default=TINY_LLAMA_ARGS["n_head"])
+@click.option("--n-local-heads", type=int, default=TINY_LLAMA_ARGS["n_local_heads"])
+@click.option("--dim", type=int, default=TINY_LLAMA_ARGS["dim"])
+@click.option("--n-fast-layer", type=int, default=TINY_LLAMA_ARGS["n_fast_layer"])
+@click.option("--max-seq-len", type=int, default=TINY_LLAMA_ARGS["max_seq_len"])
+def main(
+    output: Path,
+    decoder_config_name: str,
+    seed: int,
+    n_layer: int,
+    n_head: int,
+    n_local_heads: int,
+    dim: int,
+    n_fast_layer: int,
+    max_seq_len: int,
+):
+    output.mkdir(parents=True, exist_ok=True)
+
+    tokenizer = build_tokenizer(output / "tokenizer.tiktoken")
+    llama = build_llama(
+        tokenizer,
+        seed=seed,
+        n_layer=n_layer,
+        n_head=n_head,
+        n_local_heads=n_local_heads,
+        dim=dim,
+        n_fast_layer=n_fast_layer,
+        max_seq_len=max_seq_len,
+    )
+    # Writes config.json, model.pth and the tokenizer files
+    llama.save_pretrained(output)
+    logger.info(
+        f"Saved a {sum(p.numel() for p in llama.parameters()) / 1e6:.2f}M "
+        f"parameters LLAMA model to {output}"
+    )
+
+    decoder = build_decoder(decoder_config_name, seed=seed)
+    torch.save(decoder.state_dict(), output / DECODER_FILENAME)
+    logger.info(
+        f"Saved a {sum(p.numel() for p in decoder.parameters()) / 1e6:.2f}M "
+        f"parameters decoder to {output / DECODER_FILENAME}"
+    )
+
+
+if __name__ == "__main__":
+    main()
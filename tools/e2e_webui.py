@@ -4,7 +4,12 @@ import wave
 
 import gradio as gr
 
-from fish_speech.utils.schema import ServeMessage, ServeTextPart, ServeVQPart
+from fish_speech.utils.schema import (
+    ServeMessage,
+    ServeTextPart,
+    ServeVQPart,
+    decode_codes,
+)
 
 from .fish_e2e import FishE2EAgent, FishE2EEventType
 
@@ -50,7 +55,7 @@ class ChatState:
             if isinstance(part, ServeTextPart):
                 response += part.text
             elif isinstance(part, ServeVQPart):
-                response += f"<audio {len(part.codes[0]) / 21:.2f}s>"
+                response += f"<audio {decode_codes(part.codes).shape[-1] / 21:.2f}s>"
         return response
 
 
@@ -16,10 +16,12 @@ import soundfile as sf
 from fish_speech.utils.schema import (
     ServeChatRequest,
     ServeMessage,
+    ServeNDArray,
     ServeTextPart,
     ServeVQGANDecodeRequest,
     ServeVQGANEncodeRequest,
     ServeVQPart,
+    decode_codes,
 )
 
 
@@ -80,7 +82,7 @@ class FishE2EEvent:
     type: FishE2EEventType
     frame: np.ndarray = None
     text: str = None
-    vq_codes: list[list[int]] = None
+    vq_codes: ServeNDArray = None
 
 
 client = httpx.AsyncClient(
@@ -104,7 +106,9 @@ class FishE2EAgent:
         sf.write(audio_buffer, audio_data, sample_rate, format="WAV")
         audio_buffer.seek(0)
         # Step 1: Encode audio using VQGAN
-        encode_request = ServeVQGANEncodeRequest(audios=[audio_buffer.read()])
+        encode_request = ServeVQGANEncodeRequest(
+            audios=[audio_buffer.read()], binary=True
+        )
         encode_request_bytes = ormsgpack.packb(
             encode_request, option=ormsgpack.OPT_SERIALIZE_PYDANTIC
         )
@@ -114,8 +118,8 @@ class FishE2EAgent:
             headers={"Content-Type": "application/msgpack"},
         )
         encode_response_data = ormsgpack.unpackb(encode_response.content)
-        codes = encode_response_data["tokens"][0]
-        return codes
+        codes = decode_codes(encode_response_data["tokens"][0])
+        return ServeNDArray.from_array(codes)
 
     async def stream(
         self,
@@ -150,7 +154,7 @@ class FishE2EAgent:
                 ],
             }
         else:
-            if chat_ctx["added_sysaudio"] is False and sys_codes:
+            if chat_ctx["added_sysaudio"] is False and sys_codes is not None:
                 chat_ctx["added_sysaudio"] = True
                 chat_ctx["messages"][0].parts.append(ServeVQPart(codes=sys_codes))
 
@@ -172,11 +176,12 @@ class FishE2EAgent:
                         parts=[ServeVQPart(codes=user_codes)],
                     )
                 ]
-                if user_codes
+                if user_codes is not None
                 else []
             ),
             streaming=True,
             num_samples=1,
+            binary=True,
         )
 
         # Step 3: Stream LLM response and decode audio
@@ -188,7 +193,7 @@ class FishE2EAgent:
             nonlocal current_vq
             nonlocal vq_codes
 
-            data = np.concatenate(vq_codes, axis=1).tolist()
+            data = ServeNDArray.from_array(np.concatenate(vq_codes, axis=1))
             # Decode VQ codes to audio
             decode_request = ServeVQGANDecodeRequest(tokens=[data])
             decode_response = await self.client.post(
@@ -249,7 +254,9 @@ class FishE2EAgent:
                                 text=data["delta"]["part"]["text"],
                             )
                         elif data["delta"]["part"]["type"] == "vq":
-                            vq_codes.append(np.array(data["delta"]["part"]["codes"]))
+                            vq_codes.append(
+                                decode_codes(data["delta"]["part"]["codes"])
+                            )
                             current_vq = True
 
         if current_vq and vq_codes:
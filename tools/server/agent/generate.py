@@ -1,6 +1,14 @@
 import time
 
-from fish_speech.utils.schema import ServeMessage, ServeResponse, ServeStreamResponse
+import numpy as np
+
+from fish_speech.utils.schema import (
+    ServeMessage,
+    ServeNDArray,
+    ServeResponse,
+    ServeStreamResponse,
+    ServeVQPart,
+)
 from tools.server.agent.generation_utils import (
     initialize_decode_buffers,
     process_response_tokens,
@@ -104,6 +112,14 @@ def finalize_response(
             )
     else:
         # If not streaming, send the full messages for each sample
+        if request.binary:
+            for sample_parts in parts:
+                for part in sample_parts:
+                    if isinstance(part, ServeVQPart):
+                        part.codes = ServeNDArray.from_array(
+                            np.asarray(part.codes, dtype=np.int16)
+                        )
+
         full_messages = [
             ServeMessage(role="assistant", parts=parts[i])
             for i in range(request.num_samples)
@@ -1,6 +1,9 @@
 import time
 
+import torch
+
 from fish_speech.utils.schema import (
+    ServeNDArray,
     ServeStreamDelta,
     ServeStreamResponse,
     ServeTextPart,
@@ -45,10 +48,15 @@ def handle_semantic_tokens(tokens, config, sample_id, parts, request):
 
     # If streaming, send the VQ parts directly
     if request.streaming:
+        codes = (
+            ServeNDArray.from_array(_tokens.to(torch.int16))
+            if request.binary
+            else _tokens.tolist()
+        )
         responses.append(
             ServeStreamResponse(
                 sample_id=sample_id,
-                delta=ServeStreamDelta(part=ServeVQPart(codes=_tokens.tolist())),
+                delta=ServeStreamDelta(part=ServeVQPart(codes=codes)),
             )
         )
     else:
@@ -1,3 +1,5 @@
+import asyncio
+import time
 from argparse import ArgumentParser
 from http import HTTPStatus
 from typing import Annotated, Any
@@ -7,7 +9,15 @@ from baize.datastructures import ContentType
 from kui.asgi import HTTPException, HttpRequest
 
 from fish_speech.inference_engine import TTSInferenceEngine
+from fish_speech.utils.metrics import TIME_TO_FIRST_AUDIO
+from fish_speech.utils.profiler import RequestProfiler
 from fish_speech.utils.schema import ServeTTSRequest
+from fish_speech.utils.tracing import Trace, current_span, current_trace, finish_trace
+from tools.server.audio_encoder import (
+    FFMPEG_OUTPUT_ARGS,
+    StreamingAudioEncoder,
+    encoder_pool,
+)
 from tools.server.inference import inference_wrapper as inference
 
 
@@ -33,6 +43,132 @@ def parse_args():
     parser.add_argument("--listen", type=str, default="127.0.0.1:8080")
     parser.add_argument("--workers", type=int, default=1)
     parser.add_argument("--api-key", type=str, default=None)
+    parser.add_argument(
+        "--code-cache-dir",
+        type=str,
+        default=None,
+        help="Persist the generated semantic codes on disk, per segment",
+    )
+    parser.add_argument(
+        "--code-cache-memory-mb",
+        type=int,
+        default=0,
+        help="Size of the in-memory semantic codes cache, 0 to disable",
+    )
+    parser.add_argument(
+        "--vqgan-batch-window-ms",
+        type=float,
+        default=5,
+        help="Time window to coalesce concurrent VQGAN encode/decode requests",
+    )
+    parser.add_argument("--vqgan-max-batch-size", type=int, default=16)
+    parser.add_argument(
+        "--vqgan-max-batch-tokens",
+        type=int,
+        default=0,
+        help="Padded tokens budget of a VQGAN decode batch, 0 for no limit",
+    )
+    parser.add_argument(
+        "--memory-high-watermark",
+        type=float,
+        default=0.9,
+        help="Trim the CUDA cache when reserved memory exceeds this fraction",
+    )
+    parser.add_argument(
+        "--memory-trim-interval",
+        type=float,
+        default=0,
+        help="Also trim the CUDA cache every N seconds, 0 to disable",
+    )
+    parser.add_argument(
+        "--memory-arena-max-batch-size",
+        type=int,
+        default=0,
+        help="Reserve a memory arena for this decoder batch size, 0 to disable",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="Append the spans of each TTS request to this file (one JSON per line)",
+    )
+    parser.add_argument(
+        "--trace-format", type=str, choices=["otlp", "json"], default="otlp"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile TTS requests (torch profiler and Python stack samples)",
+    )
+    parser.add_argument("--profile-dir", type=str, default="profiles")
+    parser.add_argument(
+        "--profile-requests",
+        type=int,
+        default=1,
+        help="Number of requests to profile, the profiler is off afterwards",
+    )
+    parser.add_argument(
+        "--profile-request-id",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Only profile the requests with these X-Request-ID headers",
+    )
+    parser.add_argument(
+        "--profile-sample-rate",
+        type=float,
+        default=0,
+        help="Profile this fraction of the requests, 0 for the first ones",
+    )
+    parser.add_argument(
+        "--memory-arena-max-seq-len",
+        type=int,
+        default=4096,
+        help="Sequence length (in tokens) used to size the memory arena",
+    )
+    parser.add_argument(
+        "--voice-store-dir",
+        type=str,
+        default=None,
+        help="Persist the encoded reference voices (references/<id>) on disk",
+    )
+    parser.add_argument(
+        "--voice-store-memory-voices",
+        type=int,
+        default=64,
+        help="Number of encoded reference voices kept in memory",
+    )
+    parser.add_argument(
+        "--reference-cache-mb",
+        type=int,
+        default=256,
+        help="Size of the cache of the uploaded references, least recently used evicted",
+    )
+    parser.add_argument(
+        "--reference-cache-device-mb",
+        type=int,
+        default=None,
+        help="Offload the least recently used references to the host past this size",
+    )
+    parser.add_argument(
+        "--reference-max-tokens",
+        type=int,
+        default=None,
+        help="Token budget of the reference clips in the prompt, no budget by default",
+    )
+    parser.add_argument(
+        "--reference-order",
+        type=str,
+        choices=["given", "shortest", "longest"],
+        default="given",
+        help="Order in which the reference clips are picked under the budget",
+    )
+    parser.add_argument(
+        "--segment-batch-size",
+        type=int,
+        default=4,
+        help="Segments generated together for the requests with parallel_segments",
+    )
 
     return parser.parse_args()
 
@@ -56,15 +192,83 @@ class MsgPackRequest(HttpRequest):
 
 
 async def inference_async(req: ServeTTSRequest, engine: TTSInferenceEngine):
+    if req.format in FFMPEG_OUTPUT_ARGS:
+        async for chunk in inference_async_encoded(req, engine):
+            yield chunk
+        return
+
     for chunk in inference(req, engine):
-        if isinstance(chunk, bytes):
+        if isinstance(chunk, (bytes, memoryview)):
             yield chunk
 
 
+async def inference_async_encoded(req: ServeTTSRequest, engine: TTSInferenceEngine):
+    """
+    Stream compressed audio: each PCM segment is encoded as soon as it is decoded.
+    The encoding runs in the encoder pool, off the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    sample_rate = engine.decoder_model.spec_transform.sample_rate
+    encoder = StreamingAudioEncoder(req.format, sample_rate)
+
+    try:
+        for chunk in inference(req, engine):
+            if not isinstance(chunk, (bytes, memoryview)):
+                continue
+
+            frames = await loop.run_in_executor(encoder_pool, encoder.encode, chunk)
+            if frames:
+                yield frames
+
+        frames = await loop.run_in_executor(encoder_pool, encoder.flush)
+        if frames:
+            yield frames
+    finally:
+        encoder.close()
+
+
 async def buffer_to_async_generator(buffer):
     yield buffer
 
 
+async def observe_first_chunk(iterable, start_time: float):
+    """
+    Record the time to the first audio byte of a response.
+    """
+    first = True
+    async for chunk in iterable:
+        if first:
+            TIME_TO_FIRST_AUDIO.observe(time.perf_counter() - start_time)
+            first = False
+        yield chunk
+
+
+async def traced_stream(iterable, trace: Trace):
+    """
+    Record the spans of a streaming response, the trace is finished with the stream.
+    """
+    root = trace.start_span("http.tts", streaming=True)
+    # The context of the response task, the engine generators run in it
+    current_trace.set(trace)
+    current_span.set(root)
+
+    try:
+        async for chunk in iterable:
+            yield chunk
+    finally:
+        trace.end_span(root)
+        finish_trace(trace)
+
+
+async def profiled_stream(iterable, profiler: RequestProfiler, request_id: str):
+    """
+    Profile a streaming response until its last chunk.
+    """
+    with profiler.profile(request_id):
+        async for chunk in iterable:
+            yield chunk
+
+
 def get_content_type(audio_format):
     if audio_format == "wav":
         return "audio/wav"
@@ -72,5 +276,7 @@ def get_content_type(audio_format):
         return "audio/flac"
     elif audio_format == "mp3":
         return "audio/mpeg"
+    elif audio_format == "opus":
+        return "audio/ogg"
     else:
         return "application/octet-stream"
@@ -0,0 +1,123 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ENCODER_WORKERS = int(os.getenv("ENCODER_WORKERS", 4))
+READ_CHUNK_SIZE = 4096
+
+# Output options of ffmpeg for each compressed format
+FFMPEG_OUTPUT_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "128k", "-f", "mp3"],
+    # Opus only supports a few sample rates, 48kHz is the native one
+    "opus": ["-c:a", "libopus", "-b:a", "64k", "-ar", "48000", "-f", "ogg"],
+    "flac": ["-c:a", "flac", "-f", "flac"],
+}
+
+# Encoding runs in this pool, never on the event loop
+encoder_pool = ThreadPoolExecutor(
+    max_workers=ENCODER_WORKERS, thread_name_prefix="audio-encoder"
+)
+
+
+class StreamingAudioEncoder:
+
+    def __init__(self, audio_format: str, sample_rate: int, channels: int = 1):
+        """
+        Incremental encoder: int16 PCM in, compressed frames out.
+        Backed by an ffmpeg process reading from stdin and writing to stdout,
+        so the frames are produced as soon as enough PCM has been fed.
+        """
+        if audio_format not in FFMPEG_OUTPUT_ARGS:
+            raise ValueError(f"Unsupported streaming format: {audio_format}")
+
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg is required to stream compressed audio")
+
+        self.process = subprocess.Popen(
+            [
+                ffmpeg,
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-f",
+                "s16le",
+                "-ar",
+                str(sample_rate),
+                "-ac",
+                str(channels),
+                "-i",
+                "pipe:0",
+                *FFMPEG_OUTPUT_ARGS[audio_format],
+                "-flush_packets",
+                "1",
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        # Drain stdout in the background, otherwise ffmpeg blocks on a full pipe
+        self.frames: queue.Queue[bytes] = queue.Queue()
+        self.reader = threading.Thread(target=self._read_frames, daemon=True)
+        self.reader.start()
+
+    def _read_frames(self) -> None:
+        while True:
+            data = self.process.stdout.read1(READ_CHUNK_SIZE)
+            if not data:
+                break
+            self.frames.put(data)
+
+    def _drain(self) -> bytes:
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.frames.get_nowait())
+            except queue.Empty:
+                break
+
+        return b"".join(chunks)
+
+    def encode(self, pcm: bytes) -> bytes:
+        """
+        Feed a PCM chunk and return the compressed frames ready so far.
+        """
+        self.process.stdin.write(pcm)
+        self.process.stdin.flush()
+
+        return self._drain()
+
+    def flush(self) -> bytes:
+        """
+        Finish the stream and return the remaining compressed frames.
+        """
+        self.process.stdin.close()
+        self.reader.join()
+        returncode = self.process.wait()
+
+        if returncode != 0:
+            error = self.process.stderr.read().decode("utf-8", errors="replace")
+            raise RuntimeError(f"ffmpeg failed with code {returncode}: {error}")
+
+        return self._drain()
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def encode_audio(pcm: bytes, audio_format: str, sample_rate: int) -> bytes:
+    """
+    Encode a whole int16 PCM buffer at once.
+    """
+    encoder = StreamingAudioEncoder(audio_format, sample_rate)
+    try:
+        return encoder.encode(pcm) + encoder.flush()
+    finally:
+        encoder.close()
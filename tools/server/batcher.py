@@ -0,0 +1,144 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+
+@dataclass
+class PendingItem:
+    item: Any
+    cost: int
+    future: asyncio.Future
+    arrival: float = field(default_factory=time.monotonic)
+
+
+class MicroBatcher:
+
+    def __init__(
+        self,
+        batch_fn: Callable[[list], list],
+        max_batch_size: int = 16,
+        max_batch_cost: int = 0,
+        window_ms: float = 5.0,
+        cost_fn: Callable[[Any], int] | None = None,
+    ) -> None:
+        """
+        Coalesce the items of concurrent requests into one batch.
+        A batch is dispatched when `window_ms` elapsed since its oldest item,
+        when it holds `max_batch_size` items, or when its padded cost
+        (batch size x largest item cost) would exceed `max_batch_cost` (0 = no limit).
+        `batch_fn` runs in a dedicated thread and returns one result per item.
+        If a batch fails, its items are retried one by one, so that only the items
+        which fail themselves get the error.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_batch_cost = max_batch_cost
+        self.window = window_ms / 1000
+        self.cost_fn = cost_fn or (lambda item: 1)
+
+        # A single thread: batches run one at a time on the model
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batcher")
+        self.pending: list[PendingItem] = []
+        self.wakeup = asyncio.Event()
+        self.worker: asyncio.Task | None = None
+
+    async def submit(self, items: list) -> list:
+        """
+        Queue the items of one request and wait for their results, in order.
+        """
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+
+        for item, future in zip(items, futures):
+            self.pending.append(PendingItem(item, self.cost_fn(item), future))
+
+        if self.worker is None or self.worker.done():
+            self.worker = loop.create_task(self.run())
+        self.wakeup.set()
+
+        return list(await asyncio.gather(*futures))
+
+    def batch_size(self) -> int:
+        """
+        Number of pending items fitting in the next batch.
+        """
+        size, max_cost = 0, 0
+        for pending in self.pending[: self.max_batch_size]:
+            max_cost = max(max_cost, pending.cost)
+            if (
+                size > 0
+                and self.max_batch_cost > 0
+                and (size + 1) * max_cost > self.max_batch_cost
+            ):
+                break
+            size += 1
+
+        return size
+
+    def is_full(self) -> bool:
+        return self.batch_size() < len(self.pending) or (
+            len(self.pending) >= self.max_batch_size
+        )
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while self.pending:
+            # Wait for more items until the window of the oldest one is over
+            deadline = self.pending[0].arrival + self.window
+            while not self.is_full():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            size = self.batch_size()
+            batch, self.pending = self.pending[:size], self.pending[size:]
+
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.batch_fn, [pending.item for pending in batch]
+                )
+            except Exception as e:
+                if len(batch) == 1:
+                    self.fail(batch[0], e)
+                else:
+                    # One bad item (e.g. a malformed upload) must not fail the
+                    # other requests of the batch: retry the items one by one
+                    await self.run_one_by_one(batch)
+                continue
+
+            # Scatter the results back to the waiting requests
+            for pending, result in zip(batch, results):
+                if not pending.future.done():
+                    pending.future.set_result(result)
+
+    async def run_one_by_one(self, batch: list[PendingItem]) -> None:
+        loop = asyncio.get_running_loop()
+
+        for pending in batch:
+            if pending.future.done():
+                continue
+
+            try:
+                (result,) = await loop.run_in_executor(
+                    self.executor, self.batch_fn, [pending.item]
+                )
+            except Exception as e:
+                self.fail(pending, e)
+                continue
+
+            if not pending.future.done():
+                pending.future.set_result(result)
+
+    @staticmethod
+    def fail(pending: PendingItem, error: Exception) -> None:
+        if not pending.future.done():
+            pending.future.set_exception(error)
@@ -1,13 +1,10 @@
 from http import HTTPStatus
 
-import numpy as np
 from kui.asgi import HTTPException
 
 from fish_speech.inference_engine import TTSInferenceEngine
 from fish_speech.utils.schema import ServeTTSRequest
 
-AMPLITUDE = 32768  # Needs an explaination
-
 
 def inference_wrapper(req: ServeTTSRequest, engine: TTSInferenceEngine):
     """
@@ -30,7 +27,8 @@ def inference_wrapper(req: ServeTTSRequest, engine: TTSInferenceEngine):
             case "segment":
                 count += 1
                 if isinstance(result.audio, tuple):
-                    yield (result.audio[1] * AMPLITUDE).astype(np.int16).tobytes()
+                    # The engine already returns PCM, send it without copying
+                    yield memoryview(result.audio[1]).cast("B")
 
             case "final":
                 count += 1
@@ -3,6 +3,16 @@ from funasr import AutoModel
 from loguru import logger
 
 from fish_speech.inference_engine import TTSInferenceEngine
+from fish_speech.inference_engine.code_cache import (
+    SemanticCodeCache,
+    model_fingerprint,
+)
+from fish_speech.inference_engine.memory_manager import (
+    MemoryManager,
+    estimate_arena_bytes,
+)
+from fish_speech.inference_engine.reference_cache import ReferenceCache
+from fish_speech.inference_engine.voice_store import VoiceStore
 from fish_speech.models.text2semantic.inference import (
     launch_thread_safe_queue,
     launch_thread_safe_queue_agent,
@@ -25,6 +35,19 @@ class ModelManager:
         llama_checkpoint_path: str,
         decoder_checkpoint_path: str,
         decoder_config_name: str,
+        code_cache_dir: str | None = None,
+        code_cache_memory_mb: int = 0,
+        memory_high_watermark: float = 0.9,
+        memory_trim_interval: float = 0,
+        memory_arena_max_batch_size: int = 0,
+        memory_arena_max_seq_len: int = 4096,
+        voice_store_dir: str | None = None,
+        voice_store_memory_voices: int = 64,
+        reference_cache_mb: int = 256,
+        reference_cache_device_mb: int | None = None,
+        reference_max_tokens: int | None = None,
+        reference_order: str = "given",
+        segment_batch_size: int = 4,
     ) -> None:
 
         self.mode = mode
@@ -53,17 +76,55 @@ class ModelManager:
         self.load_decoder_model(
             decoder_config_name, decoder_checkpoint_path, self.device
         )
+        self.memory_manager = MemoryManager(
+            device=self.decoder_model.device,
+            high_watermark=memory_high_watermark,
+            trim_interval=memory_trim_interval,
+            arena_bytes=estimate_arena_bytes(
+                self.decoder_model,
+                max_batch_size=memory_arena_max_batch_size,
+                max_seq_len=memory_arena_max_seq_len,
+            ),
+        )
         self.tts_inference_engine = TTSInferenceEngine(
             llama_queue=self.llama_queue,
             decoder_model=self.decoder_model,
             precision=self.precision,
             compile=self.compile,
+            memory_manager=self.memory_manager,
+            voice_store=VoiceStore(
+                root=voice_store_dir,
+                max_memory_voices=voice_store_memory_voices,
+            ),
+            reference_cache=ReferenceCache(
+                max_bytes=reference_cache_mb * 1024 * 1024,
+                max_device_bytes=(
+                    reference_cache_device_mb * 1024 * 1024
+                    if reference_cache_device_mb is not None
+                    else None
+                ),
+            ),
+            reference_max_tokens=reference_max_tokens,
+            reference_order=reference_order,
+            segment_batch_size=segment_batch_size,
         )
 
         # Warm up the models
         if self.mode == "tts":
             self.warm_up(self.tts_inference_engine)
 
+        # Enable the codes cache after the warm up, so that it always runs the LLAMA model
+        self.tts_inference_engine.code_cache = SemanticCodeCache(
+            cache_dir=code_cache_dir,
+            max_memory_bytes=code_cache_memory_mb * 1024 * 1024,
+            # Codes generated by other checkpoints are not reused
+            fingerprint=model_fingerprint(
+                [llama_checkpoint_path, decoder_checkpoint_path],
+                decoder_config_name=decoder_config_name,
+                precision=str(self.precision),
+            ),
+        )
+
     def load_asr_model(self, device, hub="ms") -> None:
         self.asr_model = AutoModel(
             model=ASR_MODEL_NAME,
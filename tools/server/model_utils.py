@@ -1,17 +1,55 @@
 import io
+import os
 import re
+import tempfile
+import threading
+from contextlib import nullcontext
+from hashlib import blake2b
+from pathlib import Path
 
 import librosa
+import numpy as np
 import torch
 import torchaudio
-from cachetools import LRUCache, cached
+from cachetools import LRUCache
+from loguru import logger
 
-CACHE_MAXSIZE = 10000
+CACHE_MAX_BYTES = int(os.getenv("VQGAN_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CACHE_DIR = os.getenv("VQGAN_CACHE_DIR")
 MICRO_BATCH_SIZE = 8
+# Budgets of a padded batch (batch size x longest item)
+MAX_PADDED_DECODE_TOKENS = 8 * 1024
+MAX_PADDED_ENCODE_SECONDS = 240
 ASR_SAMPLE_RATE = 16000
 HUGE_GAP_THRESHOLD = 4000
 
 
+def bucket_by_length(
+    lengths: list[int], max_padded_length: int, max_batch_size: int
+) -> list[list[int]]:
+    """
+    Group the indices by length, so that each bucket (padded to its longest item)
+    stays under `max_padded_length` in total and under `max_batch_size` items.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+
+    buckets, bucket = [], []
+    for idx in order:
+        # Sorted by length, so the new item is the longest of the bucket
+        if bucket and (
+            len(bucket) >= max_batch_size
+            or (len(bucket) + 1) * lengths[idx] > max_padded_length
+        ):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(idx)
+
+    if bucket:
+        buckets.append(bucket)
+
+    return buckets
+
+
 @torch.no_grad()
 @torch.autocast(device_type="cuda", dtype=torch.half)
 def batch_encode(model, audios_list: list[bytes]):
@@ -26,60 +64,151 @@ def batch_encode(model, audios_list: list[bytes]):
         for audio in audios_list
     ]
 
-    lengths = torch.tensor([audio.shape[-1] for audio in audios], device=model.device)
-    max_length = lengths.max().item()
+    lengths = [audio.shape[-1] for audio in audios]
+    sample_rate = model.spec_transform.sample_rate
+    print(f"Encode max length: {max(lengths) / sample_rate:.2f}s")
+
+    # Encode the clips of similar lengths together, and restore the order after
+    results = [None] * len(audios)
+    for bucket in bucket_by_length(
+        lengths, int(MAX_PADDED_ENCODE_SECONDS * sample_rate), MICRO_BATCH_SIZE
+    ):
+        max_length = max(lengths[i] for i in bucket)
+        padded = torch.stack(
+            [
+                torch.nn.functional.pad(audios[i], (0, max_length - lengths[i]))
+                for i in bucket
+            ]
+        ).to(model.device)
+        bucket_lengths = torch.tensor([lengths[i] for i in bucket], device=model.device)
+
+        features, feature_lengths = model.encode(padded, audio_lengths=bucket_lengths)
+        features, feature_lengths = features.cpu(), feature_lengths.cpu()
+
+        for i, feature, length in zip(bucket, features, feature_lengths):
+            results[i] = feature[..., :length]
+
+    return results
+
+
+class VQGANEncodeCache:
+
+    def __init__(self, max_bytes: int, cache_dir: str | None = None) -> None:
+        """
+        Per-clip cache of the encoded tokens, keyed by a digest of the audio content.
+        The memory tier is bounded by the size of the tokens, not the number of clips,
+        and the optional disk tier stores the tokens as int16 .npy files.
+        """
+        self.memory = LRUCache(
+            maxsize=max_bytes,
+            getsizeof=lambda tokens: tokens.numel() * tokens.element_size(),
+        )
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.lock = threading.Lock()
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
 
-    print(f"Encode max length: {max_length / model.spec_transform.sample_rate:.2f}s")
+    @staticmethod
+    def digest(audio: bytes) -> str:
+        return blake2b(audio, digest_size=16).hexdigest()
 
-    padded = torch.stack(
-        [
-            torch.nn.functional.pad(audio, (0, int(max_length - audio.shape[-1])))
-            for audio in audios
-        ]
-    ).to(model.device)
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npy"
 
-    features, feature_lengths = model.encode(padded, audio_lengths=lengths)
-    features, feature_lengths = features.cpu(), feature_lengths.cpu()
+    def _remember(self, key: str, tokens: torch.Tensor) -> None:
+        with self.lock:
+            try:
+                self.memory[key] = tokens
+            except ValueError:
+                # Larger than the whole memory budget
+                pass
 
-    return [feature[..., :length] for feature, length in zip(features, feature_lengths)]
+    def get(self, key: str) -> torch.Tensor | None:
+        with self.lock:
+            tokens = self.memory.get(key)
+        if tokens is not None or self.cache_dir is None:
+            return tokens
 
+        path = self._path(key)
+        if not path.exists():
+            return None
 
-@cached(
-    cache=LRUCache(maxsize=CACHE_MAXSIZE),
-    key=lambda model, audios: (model.device, tuple(audios)),
-)
-def cached_vqgan_batch_encode(model, audios: list[bytes]):
-    return batch_encode(model, audios)
+        try:
+            tokens = torch.from_numpy(np.load(path).astype(np.int64))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load cached tokens {path}: {e}")
+            return None
+
+        self._remember(key, tokens)
+        return tokens
+
+    def put(self, key: str, tokens: torch.Tensor) -> None:
+        # Don't keep the whole batch alive through a view
+        tokens = tokens.clone()
+        self._remember(key, tokens)
+
+        if self.cache_dir is None:
+            return
+
+        # Write to a temporary file first, so that readers never see partial files
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, tokens.numpy().astype(np.int16))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write cached tokens {path}: {e}")
+            Path(tmp_path).unlink(missing_ok=True)
+
+
+encode_cache = VQGANEncodeCache(max_bytes=CACHE_MAX_BYTES, cache_dir=CACHE_DIR)
+
+
+def cached_vqgan_batch_encode(model, audios: list[bytes], lock=None):
+    keys = [encode_cache.digest(audio) for audio in audios]
+    tokens = {key: encode_cache.get(key) for key in keys}
+
+    # Only encode the clips that are not cached (once, even if repeated)
+    misses = {key: audio for key, audio in zip(keys, audios) if tokens[key] is None}
+    if misses:
+        # The TTS engine shares the model, see TTSInferenceEngine.decoder_lock
+        with lock or nullcontext():
+            encoded = batch_encode(model, list(misses.values()))
+        for key, result in zip(misses, encoded):
+            encode_cache.put(key, result)
+            tokens[key] = result
+
+    return [tokens[key] for key in keys]
 
 
 @torch.no_grad()
 @torch.autocast(device_type="cuda", dtype=torch.half)
-def batch_vqgan_decode(model, features):
-    lengths = torch.tensor(
-        [feature.shape[-1] for feature in features], device=model.device
-    )
-    max_length = lengths.max().item()
-    padded = torch.stack(
-        [
-            torch.nn.functional.pad(feature, (0, max_length - feature.shape[-1]))
-            for feature in features
-        ]
-    ).to(model.device)
-
-    # If bs too large, we do micro batch decode
-    audios, audio_lengths = [], []
-    for i in range(0, padded.shape[0], MICRO_BATCH_SIZE):
-        audio, audio_length = model.decode(
-            padded[i : i + MICRO_BATCH_SIZE],
-            feature_lengths=lengths[i : i + MICRO_BATCH_SIZE],
-        )
-        audios.append(audio)
-        audio_lengths.append(audio_length)
-    audios = torch.cat(audios, dim=0)
-    audio_lengths = torch.cat(audio_lengths, dim=0)
-    audios, audio_lengths = audios.cpu(), audio_lengths.cpu()
+def batch_vqgan_decode(model, features, lock=None):
+    lengths = [feature.shape[-1] for feature in features]
+
+    # Decode the features of similar lengths together, and restore the order after
+    results = [None] * len(features)
+    for bucket in bucket_by_length(lengths, MAX_PADDED_DECODE_TOKENS, MICRO_BATCH_SIZE):
+        max_length = max(lengths[i] for i in bucket)
+        padded = torch.stack(
+            [
+                torch.nn.functional.pad(features[i], (0, max_length - lengths[i]))
+                for i in bucket
+            ]
+        ).to(model.device)
+        bucket_lengths = torch.tensor([lengths[i] for i in bucket], device=model.device)
 
-    return [audio[..., :length].numpy() for audio, length in zip(audios, audio_lengths)]
+        with lock or nullcontext():
+            audios, audio_lengths = model.decode(padded, feature_lengths=bucket_lengths)
+        audios, audio_lengths = audios.cpu(), audio_lengths.cpu()
+
+        for i, audio, length in zip(bucket, audios, audio_lengths):
+            results[i] = audio[..., :length].numpy()
+
+    return results
 
 
 @torch.no_grad()
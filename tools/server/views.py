@@ -1,3 +1,4 @@
+import asyncio
 import io
 import os
 import time
@@ -12,6 +13,8 @@ from kui.asgi import (
     HTTPException,
     HttpView,
     JSONResponse,
+    Path,
+    PlainTextResponse,
     Routes,
     StreamResponse,
     request,
@@ -19,29 +22,44 @@ from kui.asgi import (
 from loguru import logger
 from typing_extensions import Annotated
 
+from fish_speech.utils.metrics import registry as metrics_registry
 from fish_speech.utils.schema import (
+    ServeAddReferenceVoiceRequest,
     ServeASRRequest,
     ServeASRResponse,
     ServeChatRequest,
+    ServeNDArray,
+    ServeReferenceVoice,
+    ServeReferenceVoiceList,
+    ServeReferenceVoiceRequest,
     ServeTTSRequest,
     ServeVQGANDecodeRequest,
     ServeVQGANDecodeResponse,
     ServeVQGANEncodeRequest,
     ServeVQGANEncodeResponse,
+    decode_codes,
+)
+from fish_speech.utils.tracing import (
+    DEBUG_TIMING_HEADER,
+    REQUEST_ID_HEADER,
+    Trace,
+    finish_trace,
+    span,
+    use_trace,
 )
 from tools.server.agent import get_response_generator
 from tools.server.api_utils import (
     buffer_to_async_generator,
     get_content_type,
     inference_async,
+    observe_first_chunk,
+    profiled_stream,
+    traced_stream,
 )
+from tools.server.audio_encoder import encode_audio, encoder_pool
 from tools.server.inference import inference_wrapper as inference
 from tools.server.model_manager import ModelManager
-from tools.server.model_utils import (
-    batch_asr,
-    batch_vqgan_decode,
-    cached_vqgan_batch_encode,
-)
+from tools.server.model_utils import batch_asr
 
 MAX_NUM_SAMPLES = int(os.getenv("NUM_SAMPLES", 1))
 
@@ -59,34 +77,53 @@ class Health(HttpView):
         return JSONResponse({"status": "ok"})
 
 
-@routes.http.post("/v1/vqgan/encode")
-async def vqgan_encode(req: Annotated[ServeVQGANEncodeRequest, Body(exclusive=True)]):
-    # Get the model from the app
+@routes.http.get("/v1/metrics")
+async def metrics():
+    # Prometheus text format
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@routes.http.get("/v1/memory")
+async def memory():
+    # Allocator stats of the decoder device, and of the references cache
     model_manager: ModelManager = request.app.state.model_manager
-    decoder_model = model_manager.decoder_model
+    return JSONResponse(
+        {
+            **model_manager.memory_manager.stats(),
+            "reference_cache": model_manager.tts_inference_engine.ref_by_hash.stats(),
+        }
+    )
+
 
-    # Encode the audio
+@routes.http.post("/v1/vqgan/encode")
+async def vqgan_encode(req: Annotated[ServeVQGANEncodeRequest, Body(exclusive=True)]):
+    # Encode the audio, batched with the concurrent requests
     start_time = time.time()
-    tokens = cached_vqgan_batch_encode(decoder_model, req.audios)
+    tokens = await request.app.state.vqgan_encode_batcher.submit(req.audios)
     logger.info(f"[EXEC] VQGAN encode time: {(time.time() - start_time) * 1000:.2f}ms")
 
     # Return the response
+    if req.binary:
+        tokens = [ServeNDArray.from_array(i.to(torch.int16)) for i in tokens]
+    else:
+        tokens = [i.tolist() for i in tokens]
+
     return ormsgpack.packb(
-        ServeVQGANEncodeResponse(tokens=[i.tolist() for i in tokens]),
+        ServeVQGANEncodeResponse(tokens=tokens),
         option=ormsgpack.OPT_SERIALIZE_PYDANTIC,
     )
 
 
 @routes.http.post("/v1/vqgan/decode")
 async def vqgan_decode(req: Annotated[ServeVQGANDecodeRequest, Body(exclusive=True)]):
-    # Get the model from the app
-    model_manager: ModelManager = request.app.state.model_manager
-    decoder_model = model_manager.decoder_model
-
-    # Decode the audio
-    tokens = [torch.tensor(token, dtype=torch.int) for token in req.tokens]
+    # Decode the audio, batched with the concurrent requests
+    tokens = [
+        torch.from_numpy(decode_codes(token).astype(np.int32)) for token in req.tokens
+    ]
     start_time = time.time()
-    audios = batch_vqgan_decode(decoder_model, tokens)
+    audios = await request.app.state.vqgan_decode_batcher.submit(tokens)
     logger.info(f"[EXEC] VQGAN decode time: {(time.time() - start_time) * 1000:.2f}ms")
     audios = [audio.astype(np.float16).tobytes() for audio in audios]
 
@@ -124,8 +161,93 @@ async def asr(req: Annotated[ServeASRRequest, Body(exclusive=True)]):
     )
 
 
+def get_reference_engine():
+    return request.app.state.model_manager.tts_inference_engine
+
+
+def pack_reference(reference: dict | None, id: str):
+    if reference is None:
+        raise HTTPException(HTTPStatus.NOT_FOUND, content=f"Unknown reference {id}")
+
+    return ormsgpack.packb(
+        ServeReferenceVoice(**reference), option=ormsgpack.OPT_SERIALIZE_PYDANTIC
+    )
+
+
+def save_reference(id: str, references: list):
+    try:
+        return get_reference_engine().save_reference(id, references)
+    except ValueError as e:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, content=str(e))
+
+
+@routes.http.get("/v1/references")
+async def list_references():
+    references = get_reference_engine().list_references()
+    return ormsgpack.packb(
+        ServeReferenceVoiceList(
+            references=[ServeReferenceVoice(**ref) for ref in references]
+        ),
+        option=ormsgpack.OPT_SERIALIZE_PYDANTIC,
+    )
+
+
+@routes.http.post("/v1/references")
+async def add_reference(
+    req: Annotated[ServeAddReferenceVoiceRequest, Body(exclusive=True)],
+):
+    # Encoded once here, TTS requests then only carry the reference_id
+    engine = get_reference_engine()
+    try:
+        exists = engine.get_reference(req.id) is not None
+    except ValueError as e:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, content=str(e))
+
+    if exists:
+        raise HTTPException(
+            HTTPStatus.CONFLICT, content=f"Reference {req.id} already exists"
+        )
+
+    return pack_reference(save_reference(req.id, req.references), req.id)
+
+
+@routes.http.get("/v1/references/{reference_id}")
+async def get_reference(reference_id: Annotated[str, Path()]):
+    try:
+        reference = get_reference_engine().get_reference(reference_id)
+    except ValueError as e:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, content=str(e))
+
+    return pack_reference(reference, reference_id)
+
+
+@routes.http.put("/v1/references/{reference_id}")
+async def update_reference(
+    reference_id: Annotated[str, Path()],
+    req: Annotated[ServeReferenceVoiceRequest, Body(exclusive=True)],
+):
+    return pack_reference(save_reference(reference_id, req.references), reference_id)
+
+
+@routes.http.delete("/v1/references/{reference_id}")
+async def delete_reference(reference_id: Annotated[str, Path()]):
+    try:
+        deleted = get_reference_engine().delete_reference(reference_id)
+    except ValueError as e:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, content=str(e))
+
+    if not deleted:
+        raise HTTPException(
+            HTTPStatus.NOT_FOUND, content=f"Unknown reference {reference_id}"
+        )
+
+    return JSONResponse({"status": "ok"})
+
+
 @routes.http.post("/v1/tts")
 async def tts(req: Annotated[ServeTTSRequest, Body(exclusive=True)]):
+    start_time = time.perf_counter()
+
     # Get the model from the app
     app_state = request.app.state
     model_manager: ModelManager = app_state.model_manager
@@ -139,39 +261,71 @@ async def tts(req: Annotated[ServeTTSRequest, Body(exclusive=True)]):
             content=f"Text is too long, max length is {app_state.max_text_length}",
         )
 
-    # Check if streaming is enabled
-    if req.streaming and req.format != "wav":
-        raise HTTPException(
-            HTTPStatus.BAD_REQUEST,
-            content="Streaming only supports WAV format",
-        )
+    # Fail before the stream is started if the voice doesn't exist
+    if req.reference_id is not None:
+        try:
+            ref_folder = engine.voice_folder(req.reference_id)
+        except ValueError as e:
+            raise HTTPException(HTTPStatus.BAD_REQUEST, content=str(e))
+        if ref_folder is None:
+            raise HTTPException(
+                HTTPStatus.NOT_FOUND, content=f"Unknown reference {req.reference_id}"
+            )
+
+    # Every request gets an id, the spans are only returned on demand
+    timing_header = request.headers.get(DEBUG_TIMING_HEADER, "0").lower()
+    debug_timing = timing_header in ("1", "true")
+    trace = Trace(request.headers.get(REQUEST_ID_HEADER), detailed=debug_timing)
+    headers = {
+        "Content-Disposition": f"attachment; filename=audio.{req.format}",
+        "X-Request-ID": trace.request_id,
+    }
 
     # Perform TTS
     if req.streaming:
+        # The headers are sent first, so the timing breakdown is only exported
+        iterable = profiled_stream(
+            inference_async(req, engine), app_state.profiler, trace.request_id
+        )
         return StreamResponse(
-            iterable=inference_async(req, engine),
-            headers={
-                "Content-Disposition": f"attachment; filename=audio.{req.format}",
-            },
+            iterable=traced_stream(observe_first_chunk(iterable, start_time), trace),
+            headers=headers,
             content_type=get_content_type(req.format),
         )
-    else:
+
+    with (
+        use_trace(trace),
+        span("http.tts", streaming=False),
+        app_state.profiler.profile(trace.request_id),
+    ):
         fake_audios = next(inference(req, engine))
-        buffer = io.BytesIO()
-        sf.write(
-            buffer,
-            fake_audios,
-            sample_rate,
-            format=req.format,
-        )
 
-        return StreamResponse(
-            iterable=buffer_to_async_generator(buffer.getvalue()),
-            headers={
-                "Content-Disposition": f"attachment; filename=audio.{req.format}",
-            },
-            content_type=get_content_type(req.format),
-        )
+        with span("audio.encode", format=req.format):
+            if req.format == "opus":
+                # libsndfile can't write opus at the decoder sample rate
+                pcm = memoryview(fake_audios).cast("B")
+                content = await asyncio.get_running_loop().run_in_executor(
+                    encoder_pool, encode_audio, pcm, req.format, sample_rate
+                )
+            else:
+                buffer = io.BytesIO()
+                sf.write(
+                    buffer,
+                    fake_audios,
+                    sample_rate,
+                    format=req.format,
+                )
+                content = buffer.getvalue()
+
+    finish_trace(trace)
+    if debug_timing:
+        headers["Server-Timing"] = trace.server_timing()
+
+    return StreamResponse(
+        iterable=observe_first_chunk(buffer_to_async_generator(content), start_time),
+        headers=headers,
+        content_type=get_content_type(req.format),
+    )
 
 
 @routes.http.post("/v1/chat")
@@ -204,7 +358,7 @@ async def chat(req: Annotated[ServeChatRequest, Body(exclusive=True)]):
     if req.streaming is False:
         result = response_generator()
         if json_mode:
-            return JSONResponse(result.model_dump())
+            return JSONResponse(result.model_dump(mode="json"))
         else:
             return ormsgpack.packb(result, option=ormsgpack.OPT_SERIALIZE_PYDANTIC)
 